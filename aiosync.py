@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+import os
+import asyncio
+import threading
+import functools
+import contextvars
+import logging
+import config
+import sync
+from sync import Sync, subprocess, sync_phase, get_url_host, need_push, parse_progress, squash_auto_commits
+from sync import pop_state, record_skip, record_outcome, record_probe, plan_sync, sync_commit, sync_merge, record_merged, record_synced
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+#run a git command on the event loop, return (returncode, stdout, stderr)
+#the process is killed after timeout seconds or when the task is cancelled
+async def git_async(argv, cwd, timeout):
+    #ssh_env may read the git config, not on the loop
+    env = await asyncio.get_running_loop().run_in_executor(None, sync.ssh_env, cwd)
+    trace = subprocess.begin(argv, {"cwd":cwd})
+    p = await asyncio.create_subprocess_exec(*argv, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, env=env, cwd=cwd)
+    try:
+        out, err = await asyncio.wait_for(p.communicate(), timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+        if p.returncode is None:
+            p.kill()
+        await p.wait()
+        subprocess.record(trace, p.returncode)
+        if isinstance(e, asyncio.CancelledError):
+            raise
+        logger.warning("git timeout: %s %s", argv, cwd)
+        return p.returncode, b"", b""
+    trace["stdout_bytes"] = len(out)
+    trace["stderr_bytes"] = len(err)
+    subprocess.record(trace, p.returncode)
+    return p.returncode, out, err
+
+#return {ref:oid} of the remote branches, None if error
+async def git_ls_remote(repo_path, remote="origin"):
+    r, out, _ = await git_async(["git", "ls-remote", "--heads", remote], repo_path, config.ASYNC_PROBE_TIMEOUT)
+    if r != 0:
+        logger.warning("ls-remote error: %s", r)
+        return None
+    heads = {}
+    for line in out.decode("utf8").split("\n"):
+        if not line:
+            continue
+        oid, ref = line.split("\t")
+        heads[ref] = oid
+    return heads
+
+async def git_fetch(repo_path):
+    r, _, err = await git_async(["git", "fetch", "--progress"], repo_path, config.ASYNC_TRANSFER_TIMEOUT)
+    metrics.add(os.path.basename(repo_path), "bytes_received", parse_progress(err.decode("utf8", "replace")))
+    if r != 0:
+        logger.warning("fetch error: %s", r)
+    return r
+
+async def git_push(repo_path):
+    r, _, err = await git_async(["git", "push", "--progress", "origin"], repo_path, config.ASYNC_TRANSFER_TIMEOUT)
+    metrics.add(os.path.basename(repo_path), "bytes_sent", parse_progress(err.decode("utf8", "replace")))
+    if r != 0:
+        logger.warning("push error: %s", r)
+    return r
+
+
+#every syncing repo is a task on one event loop instead of a pool thread,
+#the network operations wait on the loop, so hundreds of repos can be in flight
+#the local git operations (commit, merge) still run on the sync pool,
+#a cancelled repo lets its local operation finish and kills its network operation
+#network operations always use the git command, whatever the git engine
+class AsyncSync(Sync):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop = asyncio.new_event_loop()
+        #host => asyncio.Semaphore, limit concurrent network operations against one git server
+        self.host_limits = {}
+        #name => task of the syncing repo, only used on the loop
+        self.tasks = {}
+        thread = threading.Thread(target=self.loop.run_forever, daemon=True, name="aiosync", args=())
+        thread.start()
+
+    def host_limit(self, url):
+        host = get_url_host(url)
+        sem = self.host_limits.get(host)
+        if sem is None:
+            sem = asyncio.Semaphore(self.host_workers)
+            self.host_limits[host] = sem
+        return sem
+
+    def submit(self, repo, workspace):
+        return asyncio.run_coroutine_threadsafe(self.sync_one_async(repo, workspace), self.loop)
+
+    def handle_item(self, item):
+        super().handle_item(item)
+        if item["disabled"] and not item.get("force", False):
+            self.loop.call_soon_threadsafe(self.cancel, item["name"])
+
+    def cancel(self, name):
+        task = self.tasks.get(name)
+        if task:
+            logger.info("cancel sync: %s", name)
+            task.cancel()
+
+    #run a blocking local step on the sync pool, it always runs to the end,
+    #a cancelled task waits for it before the cancellation goes on
+    async def local(self, fn, *args):
+        f = self.loop.run_in_executor(self.pool, functools.partial(contextvars.copy_context().run, fn, *args))
+        try:
+            return await asyncio.shield(f)
+        except asyncio.CancelledError:
+            await asyncio.wait([f])
+            raise
+
+    #same result as Sync.sync_one
+    async def sync_one_async(self, repo, workspace):
+        name = repo["name"]
+        if not self.acquire_repo(name):
+            logger.info("repo is syncing by other worker, skip: %s", name)
+            return None
+        self.tasks[name] = asyncio.current_task()
+        try:
+            with subprocess.context(name):
+                head = self.get_state(name).get("head_oid")
+                r = await self._sync_one_async(repo, workspace)
+                return r, self.get_state(name).get("head_oid") != head
+        finally:
+            self.tasks.pop(name, None)
+            self.release_repo(name)
+
+    async def _sync_one_async(self, repo, workspace):
+        state = self.get_state(repo["name"])
+        pop_state(state, "remote_oid")
+        if "branch" not in repo and "branch" in state:
+            repo["branch"] = state["branch"]
+        begin = await self.local(self.begin_sync, repo, workspace)
+        if begin is None:
+            return False
+        repo_path, branch, commit, state = begin
+        try:
+            with sync_phase(repo["name"], "sync") as phase:
+                r = await self.sync_repo(repo, repo_path, branch, commit, state)
+                phase.ok = r
+        except asyncio.CancelledError:
+            self.event_q.put_nowait({"event":"repo_end", "name":repo["name"], "syncing":False, "result":False})
+            raise
+        await self.local(self.end_sync, repo, repo_path, r)
+        return r
+
+    #sync.sync_repo with awaited network phases, the probe of Sync.probe_repo comes first
+    #the local phases run on the sync pool
+    async def sync_repo(self, repo, repo_path, branch, commit, state):
+        logger.info("sync repo: %s branch: %s", repo_path, branch)
+        name = repo["name"]
+        with subprocess.context(name, "probe"):
+            async with self.host_limit(repo["url"]):
+                heads = await git_ls_remote(repo_path)
+        record_probe(state, heads, branch)
+
+        moved, merged, fetch = plan_sync(repo_path, branch, state)
+        if fetch:
+            with sync_phase(name, "fetch") as phase:
+                async with self.host_limit(repo["url"]):
+                    r = await git_fetch(repo_path)
+                phase.ok = r == 0
+            record_outcome(state, "fetch", r)
+            if r != 0:
+                return False
+
+        if await self.local(sync_commit, name, repo_path, commit, moved, state) != 0:
+            return False
+        if await self.local(sync_merge, name, repo_path, branch, merged, state) != 0:
+            return False
+
+        if not await self.local(need_push, repo_path, branch):
+            logger.info("no commit to push")
+            record_skip(state, "push")
+        else:
+            with sync_phase(name, "push") as phase:
+                if sync.squash_push:
+                    await self.local(squash_auto_commits, repo_path, branch)
+                async with self.host_limit(repo["url"]):
+                    r = await git_push(repo_path)
+                phase.ok = r == 0
+            record_outcome(state, "push", r)
+            if r != 0:
+                return False
+            record_merged(repo_path, branch, state)
+
+        record_synced(repo_path, state)
+        return True
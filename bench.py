@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+#offline sync benchmarks against local bare remotes, no gui
+#python3 bench.py [-s scenario ...] [--rounds N] [--engine pygit2] [--merge-engine merge-tree] [--sync-engine async] [--binary-tuning] [-o result.json]
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import tempfile
+import threading
+import resource
+import contextlib
+import subprocess
+import config
+import sync
+from sync import Sync
+from metrics import metrics
+from eventbus import EventBus
+from maintenance import tune_binaries
+
+SCENARIOS = ("small_files", "large_binaries", "idle", "conflict_storm", "many_repos")
+
+
+def git(args, cwd):
+    subprocess.run(["git"] + args, cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+#a bare remote with one commit
+def make_remote(root, name, files=None):
+    bare = os.path.join(root, "remotes", name + ".git")
+    os.makedirs(bare)
+    git(["init", "-q", "--bare", "-b", "master"], bare)
+    seed = os.path.join(root, "seed", name)
+    os.makedirs(seed)
+    git(["init", "-q", "-b", "master"], seed)
+    for filename, data in (files or {"README":b"bench\n"}).items():
+        write_file(os.path.join(seed, filename), data)
+    git(["add", "."], seed)
+    git(["commit", "-q", "-m", "init"], seed)
+    git(["push", "-q", bare, "master"], seed)
+    shutil.rmtree(seed)
+    return bare
+
+
+#git processes traced by sync.subprocess, and their cpu seconds per phase
+class ProcessCounter(object):
+    def __init__(self):
+        self.count = 0
+        self.cpu = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, trace):
+        with self.lock:
+            self.count += 1
+            phase = trace["phase"] or "other"
+            self.cpu[phase] = self.cpu.get(phase, 0) + (trace["cpu"] or 0)
+
+    def install(self):
+        sync.subprocess.add_hook(self)
+
+
+def usage():
+    s = resource.getrusage(resource.RUSAGE_SELF)
+    c = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "cpu":s.ru_utime + s.ru_stime + c.ru_utime + c.ru_stime,
+        "inblock":s.ru_inblock + c.ru_inblock,
+        "oublock":s.ru_oublock + c.ru_oublock,
+    }
+
+#silence the sync prints and the git output, they share fd 1 with the json report
+@contextlib.contextmanager
+def quiet(enabled):
+    if not enabled:
+        yield
+        return
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    if not samples:
+        return 0
+    return samples[min(len(samples) - 1, int(len(samples)*q))]
+
+
+class Client(object):
+    def __init__(self, root, name, repos, workers, sync_class=Sync, attributes_file=None):
+        self.workspace = os.path.join(root, name)
+        os.makedirs(self.workspace)
+        self.sync = sync_class([dict(repo) for repo in repos], EventBus(), config.SYNC_INTERVAL, os.devnull, workers)
+        self.sync.attributesFile = attributes_file
+
+    def path(self, repo, *names):
+        return os.path.join(self.workspace, repo, *names)
+
+    #what the maintenance does for the binary types, before the changes are synced
+    def tune(self):
+        for repo in self.sync.repos:
+            tune_binaries(self.path(repo["name"]), self.sync.get_state(repo["name"]))
+
+    def sync_repos(self):
+        self.sync.sync_repos(self.sync.repos, self.workspace)
+
+
+class Bench(object):
+    def __init__(self, args):
+        self.args = args
+        self.counter = ProcessCounter()
+        self.counter.install()
+        self.rng = random.Random(args.seed)
+        self.sync_class = Sync
+        if args.sync_engine == "async":
+            from aiosync import AsyncSync
+            self.sync_class = AsyncSync
+
+    def setup(self, root, names, clients=1, files=None):
+        repos = [{"name":name, "url":make_remote(root, name, files), "disabled":False} for name in names]
+        attributes_file = None
+        if self.args.binary_tuning:
+            #the global attributes file of main.createAttributesFile
+            attributes_file = os.path.join(root, ".gitattributes")
+            with open(attributes_file, "w") as f:
+                f.writelines("*.%s -delta -diff\n" % ext for ext in config.BINARY_EXTENSIONS)
+        clients = [Client(root, "client%d" % i, repos, self.args.workers, self.sync_class, attributes_file) for i in range(clients)]
+        for client in clients:
+            #clone, not measured
+            client.sync_repos()
+        return clients
+
+    #the round callbacks change the worktrees, only the syncs are measured
+    def measure(self, rounds, change, clients):
+        latencies = []
+        processes = 0
+        before = usage()
+        git_cpu = dict(self.counter.cpu)
+        wall = 0
+        for i in range(rounds):
+            change(i)
+            for client in clients:
+                if self.args.binary_tuning:
+                    client.tune()
+                count = self.counter.count
+                begin = time.monotonic()
+                client.sync_repos()
+                latencies.append(time.monotonic() - begin)
+                wall += latencies[-1]
+                processes += self.counter.count - count
+        after = usage()
+        syncs = len(latencies)
+        return {
+            "syncs":syncs,
+            "wall":wall,
+            "latency":{
+                "mean":wall/syncs if syncs else 0,
+                "p50":percentile(latencies, 0.5),
+                "p90":percentile(latencies, 0.9),
+                "max":max(latencies) if latencies else 0,
+            },
+            "processes":processes,
+            "processes_per_sync":processes/syncs if syncs else 0,
+            "cpu":after["cpu"] - before["cpu"],
+            "inblock":after["inblock"] - before["inblock"],
+            "oublock":after["oublock"] - before["oublock"],
+            #cpu of the git processes, children included, per sync phase
+            "git_cpu":{phase:cpu - git_cpu.get(phase, 0) for phase, cpu in self.counter.cpu.items() if cpu > git_cpu.get(phase, 0)},
+        }
+
+    def small_files(self, root):
+        client, = self.setup(root, ["small"])
+        def change(i):
+            for n in range(self.args.files):
+                write_file(client.path("small", "d%d" % (n % 10), "f%d.txt" % n), ("%d %d\n" % (i, n)).encode("utf8"))
+        return self.measure(self.args.rounds, change, [client])
+
+    def large_binaries(self, root):
+        client, = self.setup(root, ["large"])
+        size = self.args.binary_mb * 1024 * 1024
+        def change(i):
+            write_file(client.path("large", "blob%d.bin" % (i % 3)), self.rng.randbytes(size))
+        return self.measure(self.args.rounds, change, [client])
+
+    def idle(self, root):
+        names = ["idle%d" % i for i in range(self.args.repos)]
+        client, = self.setup(root, names)
+        return self.measure(self.args.rounds, lambda i: None, [client])
+
+    #both clients change the same files between syncs
+    def conflict_storm(self, root):
+        a, b = self.setup(root, ["storm"], 2)
+        def change(i):
+            for n in range(self.args.conflicts):
+                write_file(a.path("storm", "c%d.txt" % n), ("a %d\n" % i).encode("utf8"))
+                write_file(b.path("storm", "c%d.txt" % n), ("b %d\n" % i).encode("utf8"))
+        return self.measure(self.args.rounds, change, [a, b])
+
+    #hundreds of repos, a few change each round
+    def many_repos(self, root):
+        names = ["repo%03d" % i for i in range(self.args.many)]
+        client, = self.setup(root, names)
+        def change(i):
+            for name in self.rng.sample(names, max(1, len(names)//10)):
+                write_file(client.path(name, "change.txt"), ("%d\n" % i).encode("utf8"))
+        return self.measure(self.args.rounds, change, [client])
+
+    def run(self, scenario):
+        root = tempfile.mkdtemp(prefix="gitcloud-bench-")
+        try:
+            with quiet(not self.args.verbose):
+                result = getattr(self, scenario)(root)
+                #the setup clones are measured too
+                result["metrics"] = metrics.totals()
+                metrics.reset()
+        finally:
+            if not self.args.keep:
+                shutil.rmtree(root, ignore_errors=True)
+        result["scenario"] = scenario
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="gitcloud sync benchmarks")
+    parser.add_argument("-s", "--scenario", action="append", choices=SCENARIOS, help="default all")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--repos", type=int, default=20, help="repos of the idle scenario")
+    parser.add_argument("--many", type=int, default=200, help="repos of the many_repos scenario")
+    parser.add_argument("--files", type=int, default=200, help="files changed per round by small_files")
+    parser.add_argument("--binary-mb", type=int, default=8)
+    parser.add_argument("--conflicts", type=int, default=10, help="files changed by both clients per round")
+    parser.add_argument("--workers", type=int, default=config.SYNC_WORKERS)
+    parser.add_argument("--engine", default="subprocess")
+    parser.add_argument("--merge-engine", default="worktree")
+    parser.add_argument("--sync-engine", default="thread", choices=("thread", "async"))
+    parser.add_argument("--binary-tuning", action="store_true", help="attributes and compression of the binary types, see maintenance.tune_binaries")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="write the json result to this file")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary repos")
+    args = parser.parse_args()
+
+    #reproducible commits, independent of the user's git config
+    for key, value in (("GIT_AUTHOR_NAME", "bench"), ("GIT_AUTHOR_EMAIL", "bench@localhost"),
+                       ("GIT_COMMITTER_NAME", "bench"), ("GIT_COMMITTER_EMAIL", "bench@localhost"),
+                       ("GIT_CONFIG_NOSYSTEM", "1")):
+        os.environ.setdefault(key, value)
+    with quiet(not args.verbose):
+        sync.set_git_engine(args.engine)
+        sync.set_merge_engine(args.merge_engine)
+
+    bench = Bench(args)
+    results = []
+    for scenario in args.scenario or SCENARIOS:
+        print("run:", scenario, file=sys.stderr)
+        results.append(bench.run(scenario))
+    report = {
+        "engine":sync.engine.name,
+        "merge_engine":sync.merge_engine,
+        "sync_engine":args.sync_engine,
+        "binary_tuning":args.binary_tuning,
+        "rounds":args.rounds,
+        "git":subprocess.run(["git", "--version"], stdout=subprocess.PIPE, text=True).stdout.strip(),
+        "results":results,
+    }
+    data = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(data)
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    main()
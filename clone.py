@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+import os
+import re
+import time
+import shutil
+import threading
+import logging
+import config
+import sync
+from sync import subprocess, sync_phase, git_config, parse_progress
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+#"Receiving objects:  45% (9/20), 1.20 MiB | 1.10 MiB/s"
+CLONE_PROGRESS_RE = re.compile(r"(Receiving objects|Resolving deltas|Updating files):\s+(\d+)%")
+#share of the clone stages in the total percent
+CLONE_STAGES = {"Receiving objects":(0, 80), "Resolving deltas":(80, 95), "Updating files":(95, 100)}
+
+
+#percent of the whole clone from one progress line, None if it isn't a stage line
+def clone_percent(line):
+    m = CLONE_PROGRESS_RE.search(line)
+    if not m:
+        return None
+    begin, end = CLONE_STAGES[m.group(1)]
+    return begin + (end - begin) * int(m.group(2)) // 100
+
+
+#one clone in its own thread, the repo is cloned into a hidden directory
+#and renamed to the repo path when it's complete, so a partial clone is never synced
+class CloneJob(object):
+    def __init__(self, cloner, repo, workspace):
+        self.cloner = cloner
+        self.repo = repo
+        self.name = repo["name"]
+        self.repo_path = os.path.join(workspace, self.name)
+        self.clone_path = os.path.join(workspace, ".%s.clone" % self.name)
+        self.depth = repo.get("depth", config.SHALLOW_DEPTH) if repo.get("shallow") else None
+        self.lock = threading.Lock()
+        self.process = None
+        self.cancelled = False
+        self.result = None
+        self.progress = 0
+        self.done = threading.Event()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            p = self.process
+        if p and p.poll() is None:
+            logger.info("cancel clone: %s", self.name)
+            p.terminate()
+
+    def set_progress(self, progress):
+        if progress <= self.progress:
+            return
+        self.progress = progress
+        self.cloner.event_q.put_nowait({"event":"repo_progress", "name":self.name, "progress":progress})
+
+    #a repo with folders is a blobless partial clone, only the root files are checked out until git_sparse_checkout
+    #a full clone borrows the objects of the shared object cache when it's enabled
+    def git_clone(self):
+        argv = ["git", "clone", "--progress"]
+        if self.depth is not None:
+            argv += ["--depth", str(self.depth)]
+        if self.repo.get("folders") is not None:
+            argv += ["--filter=blob:none", "--sparse"]
+        #the fetch into the cache reports the first part of the progress, the clone the rest
+        span = (0, 100)
+        cache = self.cloner.sync.object_cache
+        if cache and self.depth is None and self.repo.get("folders") is None:
+            split = config.SHARED_OBJECTS_PROGRESS
+            reference = cache.borrow(self.name, self.repo["url"], self.repo_path, lambda argv, cwd: self.run_git(argv, cwd, (0, split)))
+            if reference:
+                argv += ["--reference", reference]
+                span = (split, 100)
+        argv += [self.repo["url"], self.clone_path]
+        return self.run_git(argv, os.path.dirname(self.clone_path), span)
+
+    #git clone/fetch --progress, stderr is read as it's written for the percent events
+    #span: (begin, end) of the job's progress the command reports
+    def run_git(self, argv, cwd, span=(0, 100)):
+        begin, end = span
+        with self.lock:
+            if self.cancelled:
+                return 1
+            p = subprocess.Popen(argv, stderr=subprocess.PIPE, env=sync.ssh_env(cwd), cwd=cwd)
+            self.process = p
+
+        err = b""
+        line = b""
+        while True:
+            data = os.read(p.stderr.fileno(), 4096)
+            if not data:
+                break
+            err += data
+            for c in re.split(rb"([\r\n])", data):
+                if c in (b"\r", b"\n"):
+                    progress = clone_percent(line.decode("utf8", "replace"))
+                    if progress is not None:
+                        self.set_progress(begin + (end - begin) * progress // 100)
+                    line = b""
+                else:
+                    line += c
+        p.stderr.close()
+        p.trace["stderr_bytes"] = len(err)
+        r = p.wait()
+        metrics.add(self.name, "bytes_received", parse_progress(err.decode("utf8", "replace")))
+        if r != 0:
+            logger.warning("%s error: %s %s", argv[1], self.name, r)
+        return r
+
+    def clone(self):
+        #left by a killed run, git can't resume it
+        shutil.rmtree(self.clone_path, ignore_errors=True)
+        with sync_phase(self.name, "clone") as phase:
+            r = self.git_clone()
+            phase.ok = r == 0
+        if r == 0:
+            r = git_config(self.clone_path, self.cloner.sync.excludesFile, self.cloner.sync.attributesFile)
+        with self.lock:
+            if r == 0 and not self.cancelled:
+                os.rename(self.clone_path, self.repo_path)
+                return 0
+        shutil.rmtree(self.clone_path, ignore_errors=True)
+        return r if r else 1
+
+    def run(self):
+        event_q = self.cloner.event_q
+        event_q.put_nowait({"event":"repo_begin", "name":self.name, "syncing":True, "progress":0, "lastSyncTime":int(time.time())})
+        r = 1
+        try:
+            with self.cloner.sem:
+                if not self.cancelled:
+                    r = self.clone()
+        except Exception as e:
+            logger.exception("clone exception: %s", self.name)
+        self.result = r
+        event_q.put_nowait({"event":"repo_end", "name":self.name, "syncing":False, "progress":None, "result":r == 0})
+        self.cloner.job_done(self)
+
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True, name="clone-%s" % self.name, args=())
+        thread.start()
+
+
+#background clones, they don't take a sync worker or the host semaphore,
+#so the other repos keep syncing on schedule during a long clone
+class Cloner(object):
+    def __init__(self, syncer, workers=config.CLONE_WORKERS):
+        self.sync = syncer
+        self.event_q = syncer.event_q
+        self.lock = threading.Lock()
+        #limit the concurrent clones, the rest wait in their threads
+        self.sem = threading.BoundedSemaphore(workers)
+        #name => CloneJob
+        self.jobs = {}
+
+    #start a clone of the repo, False if one is running
+    def start(self, repo, workspace):
+        with self.lock:
+            if repo["name"] in self.jobs:
+                return False
+            job = CloneJob(self, repo, workspace)
+            self.jobs[repo["name"]] = job
+        logger.info("clone repo: %s %s", repo["name"], repo["url"])
+        job.start()
+        return True
+
+    def cancel(self, name):
+        with self.lock:
+            job = self.jobs.get(name)
+        if job:
+            job.cancel()
+
+    def wait(self, names):
+        with self.lock:
+            jobs = [self.jobs[name] for name in names if name in self.jobs]
+        for job in jobs:
+            job.done.wait()
+
+    def job_done(self, job):
+        with self.lock:
+            self.jobs.pop(job.name, None)
+        try:
+            self.sync.clone_done(job)
+        finally:
+            job.done.set()
@@ -3,4 +3,123 @@ if DEBUG:
     SYNC_INTERVAL = 10 #second
 else:
     SYNC_INTERVAL = 180 #second
-GIT = "git"
\ No newline at end of file
+GIT = "git"
+#name of the data directory
+APPNAME = "gitcloud"
+
+#max repos synced concurrently
+SYNC_WORKERS = 4
+#max concurrent syncs against one git host
+SYNC_HOST_WORKERS = 2
+
+#watch mode, seconds without writes before a changed repo is synced
+WATCH_DEBOUNCE = 2
+#watch mode, sync a repo written continuously at least this often
+WATCH_MAX_DELAY = 30
+#watch mode, seconds between the full git status of a repo, in case the events were lost
+WATCH_RESCAN = 600
+
+#shallow repos keep this many commits
+SHALLOW_DEPTH = 10
+#seconds between re-shallowing a shallow repo
+SHALLOW_PRUNE_INTERVAL = 24*3600
+#seconds between maintenance checks
+MAINTENANCE_CHECK_INTERVAL = 60
+#seconds between the object counts of one repo
+MAINTENANCE_REPO_INTERVAL = 3600
+#git maintenance runs when a repo has this many loose objects
+MAINTENANCE_LOOSE_OBJECTS = 1000
+#or this many pack files
+MAINTENANCE_PACKS = 10
+#seconds between commit-graph writes when no other task runs
+MAINTENANCE_GRAPH_INTERVAL = 24*3600
+
+#local webhook listener port
+WEBHOOK_PORT = 8754
+#poll interval when the webhook and the watcher notify all changes
+WEBHOOK_POLL_INTERVAL = 3600
+
+#adaptive schedule, a repo syncs every SYNC_INTERVAL * factor seconds
+#the factor halves after a sync that changed the repo and grows while it's idle
+SCHEDULE_MIN_FACTOR = 0.25
+SCHEDULE_MAX_FACTOR = 8
+SCHEDULE_IDLE_GROWTH = 1.5
+#floor of the adaptive interval
+SCHEDULE_MIN_INTERVAL = 5
+#cap of the failure backoff
+SCHEDULE_MAX_BACKOFF = 3600
+
+#seconds of sync events merged into one ui update
+EVENT_WINDOW = 0.1
+
+#seconds of repo db changes merged into one write
+STORE_FLUSH_DELAY = 1
+#journal records before the repo db is rewritten
+STORE_COMPACT_RECORDS = 1000
+
+#samples kept per repo and phase for the percentiles
+METRICS_WINDOW = 200
+#local prometheus endpoint port
+METRICS_PORT = 8755
+
+#git invocations kept in memory for profiling
+TRACE_BUFFER = 1000
+
+#max seconds a commit is deferred by the commit quiet period
+COMMIT_MAX_DELAY = 300
+
+#changed files at least this large are hashed in parallel when parallel_hash is set
+PARALLEL_HASH_MIN_SIZE = 4*1024*1024
+PARALLEL_HASH_WORKERS = 4
+
+#max concurrent background clones
+CLONE_WORKERS = 2
+
+#unix socket of the control api in the data directory
+CONTROL_SOCKET = "control.sock"
+
+#directory of the shared ssh connections, short: a unix socket path is limited to 104 bytes on macos
+SSH_CONTROL_DIR = "~/.ssh/gitcloud"
+#bytes of a control socket path: the directory, "/", %C (40) and the temporary suffix of ssh (17)
+SSH_SOCKET_MAX_PATH = 100
+#seconds a repo's core.sshCommand is cached
+SSH_COMMAND_TTL = 60
+
+#async sync engine, seconds before a git ls-remote is killed
+ASYNC_PROBE_TIMEOUT = 60
+#async sync engine, seconds before a git fetch or push is killed
+ASYNC_TRANSFER_TIMEOUT = 1800
+
+#bare repo of the shared object cache in the data directory
+SHARED_OBJECTS = "shared-objects.git"
+#percent of the clone progress taken by the fetch into the object cache, the clone takes the rest
+SHARED_OBJECTS_PROGRESS = 80
+
+#sqlite index of the file versions in the .git directory of each repo
+HISTORY_DB = "gitcloud-history.db"
+#versions returned by a history query
+HISTORY_LIMIT = 100
+
+#concurrent pushes to the mirror remotes, they never take a sync worker
+MIRROR_WORKERS = 4
+#seconds before a mirror push is killed
+MIRROR_PUSH_TIMEOUT = 600
+#first retry delay of a failing mirror, doubled on each failure
+MIRROR_RETRY = 60
+#cap of the mirror backoff
+MIRROR_MAX_BACKOFF = 3600
+
+#incompressible file types, -delta -diff in the managed attributes file
+BINARY_EXTENSIONS = ("jpg", "jpeg", "png", "gif", "webp", "heic", "mp3", "m4a", "aac", "ogg", "flac",
+                     "mp4", "m4v", "mov", "mkv", "avi", "webm", "zip", "gz", "tgz", "bz2", "xz", "7z", "rar",
+                     "pdf", "docx", "xlsx", "pptx", "odt", "ods", "odp", "epub", "jar", "apk", "dmg", "woff", "woff2")
+#bytes read from a file of an unknown type to test it
+BINARY_SAMPLE_SIZE = 64*1024
+#a sample that zlib shrinks less than this is incompressible
+BINARY_RATIO = 0.95
+#a repo is binary heavy when this share of its bytes is incompressible
+BINARY_REPO_SHARE = 0.5
+#zlib level of the binary heavy repos, their objects barely compress anyway
+BINARY_COMPRESSION = 1
+#larger files of the binary heavy repos are never delta compressed
+BINARY_BIG_FILE_THRESHOLD = "32m"
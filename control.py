@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+#local control api of the sync daemon, one json request and one json response per line
+#{"method":"sync_repo", "args":["notes"]} => {"result":null} or {"error":"..."}
+#python3 control.py status|add|delete|sync|auto-sync|interval|versions|conflicts|restore|mirrors ...
+import os
+import sys
+import json
+import socket
+import argparse
+import threading
+import logging
+import config
+
+logger = logging.getLogger(__name__)
+
+#the Api methods callable over the socket
+METHODS = ("status", "add_repo", "delete_repo", "sync_repo", "auto_sync_repo", "set_interval",
+           "get_file_versions", "get_conflicted_copies", "restore_file_version", "set_repo_mirrors", "get_mirrors")
+
+
+def socket_path():
+    import appdirs
+    return os.path.join(appdirs.user_data_dir(config.APPNAME), config.CONTROL_SOCKET)
+
+
+#unix socket server, the window's js api and the control clients call the same Api object
+class ControlServer(object):
+    def __init__(self, api, path):
+        self.api = api
+        self.path = path
+        self.sock = None
+
+    @staticmethod
+    def available():
+        return hasattr(socket, "AF_UNIX")
+
+    def call(self, request):
+        method = request.get("method")
+        if method not in METHODS:
+            return {"error":"unknown method: %s" % method}
+        try:
+            result = getattr(self.api, method)(*request.get("args", []), **request.get("kwargs", {}))
+        except Exception as e:
+            logger.warning("control call error: %s %s", method, e)
+            return {"error":str(e) or type(e).__name__}
+        return {"result":result}
+
+    def handle(self, conn):
+        with conn, conn.makefile("rb") as r, conn.makefile("wb") as w:
+            for line in r:
+                try:
+                    request = json.loads(line.decode("utf8"))
+                except ValueError as e:
+                    response = {"error":"invalid request"}
+                else:
+                    response = self.call(request)
+                w.write((json.dumps(response) + "\n").encode("utf8"))
+                w.flush()
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError as e:
+                #closed
+                return
+            thread = threading.Thread(target=self.handle, daemon=True, args=(conn,))
+            thread.start()
+
+    #also the single instance check, done before anything else starts:
+    #a second daemon would sync the same worktrees
+    def bind(self):
+        if os.path.exists(self.path):
+            try:
+                ControlClient(self.path).call("status")
+            except OSError as e:
+                #left by a daemon that didn't exit cleanly
+                os.remove(self.path)
+            else:
+                raise RuntimeError("gitcloud is already running: %s" % self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self.path)
+        except OSError as e:
+            sock.close()
+            #bound by a daemon started meanwhile
+            raise RuntimeError("gitcloud is already running: %s %s" % (self.path, e))
+        os.chmod(self.path, 0o600)
+        #the connections wait in the backlog until start
+        sock.listen()
+        self.sock = sock
+
+    def start(self):
+        if self.sock is None:
+            self.bind()
+        thread = threading.Thread(target=self.run, daemon=True, args=())
+        thread.start()
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.remove(self.path)
+            except OSError as e:
+                pass
+
+
+class ControlClient(object):
+    def __init__(self, path=None):
+        self.path = path or socket_path()
+
+    def call(self, method, *args, **kwargs):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.path)
+            sock.sendall((json.dumps({"method":method, "args":args, "kwargs":kwargs}) + "\n").encode("utf8"))
+            with sock.makefile("rb") as r:
+                response = json.loads(r.readline().decode("utf8"))
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response["result"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="control the gitcloud daemon")
+    parser.add_argument("--socket", help="default %s in the data directory" % config.CONTROL_SOCKET)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status")
+    p = commands.add_parser("add")
+    p.add_argument("name")
+    p.add_argument("url")
+    p.add_argument("--shallow", action="store_true")
+    p.add_argument("--folder", action="append", help="sync only this folder, repeatable")
+    p.add_argument("--mirror", action="append", help="also push to this url, repeatable")
+    p = commands.add_parser("delete")
+    p.add_argument("name")
+    p = commands.add_parser("sync")
+    p.add_argument("name")
+    p = commands.add_parser("auto-sync")
+    p.add_argument("name")
+    p.add_argument("enabled", choices=("on", "off"))
+    p = commands.add_parser("interval")
+    p.add_argument("seconds", type=int)
+    p = commands.add_parser("versions")
+    p.add_argument("name")
+    p.add_argument("path")
+    p.add_argument("--limit", type=int, default=config.HISTORY_LIMIT)
+    p = commands.add_parser("conflicts")
+    p.add_argument("name")
+    p.add_argument("path", nargs="?")
+    p = commands.add_parser("restore")
+    p.add_argument("name")
+    p.add_argument("path")
+    p.add_argument("commit")
+    p = commands.add_parser("mirrors", help="the mirrors status, or set the mirrors of a repo")
+    p.add_argument("name", nargs="?")
+    p.add_argument("urls", nargs="*", help="no url removes the mirrors")
+    args = parser.parse_args()
+
+    client = ControlClient(args.socket)
+    try:
+        if args.command == "status":
+            result = client.call("status")
+        elif args.command == "add":
+            result = client.call("add_repo", args.name, args.url, args.shallow, args.folder, args.mirror)
+        elif args.command == "delete":
+            result = client.call("delete_repo", args.name)
+        elif args.command == "sync":
+            result = client.call("sync_repo", args.name)
+        elif args.command == "auto-sync":
+            result = client.call("auto_sync_repo", args.name, args.enabled == "on")
+        elif args.command == "interval":
+            result = client.call("set_interval", args.seconds)
+        elif args.command == "versions":
+            result = client.call("get_file_versions", args.name, args.path, args.limit)
+        elif args.command == "conflicts":
+            result = client.call("get_conflicted_copies", args.name, args.path)
+        elif args.command == "restore":
+            result = client.call("restore_file_version", args.name, args.path, args.commit)
+        elif args.name is None:
+            result = client.call("get_mirrors")
+        else:
+            result = client.call("set_repo_mirrors", args.name, args.urls)
+    except OSError as e:
+        print("can't connect to gitcloud: %s" % e, file=sys.stderr)
+        return 2
+    except RuntimeError as e:
+        print("error: %s" % e, file=sys.stderr)
+        return 1
+    if result is not None:
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
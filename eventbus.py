@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+import time
+import queue
+import threading
+import config
+
+
+#sync events merged into one state diff per frame window
+#a repo keeps only its latest fields, so the bus is bounded by the number of repos
+#and put_nowait never blocks or raises queue.Full like a bounded queue.Queue
+class EventBus(object):
+    def __init__(self, window=config.EVENT_WINDOW):
+        self.window = window
+        self.cond = threading.Condition()
+        #name => changed fields
+        self.diff = {}
+        #event => last repo independent event, "begin" and "end"
+        self.events = {}
+
+    def put_nowait(self, item):
+        with self.cond:
+            name = item.get("name")
+            if name is None:
+                self.events.pop(item["event"], None)
+                self.events[item["event"]] = item
+            else:
+                fields = self.diff.setdefault(name, {})
+                fields.update((k, v) for k, v in item.items() if k not in ("event", "name"))
+            self.cond.notify_all()
+
+    def put(self, item, block=True, timeout=None):
+        self.put_nowait(item)
+
+    def empty(self):
+        with self.cond:
+            return not self.diff and not self.events
+
+    #wait for an event, then collect the rest of the frame into (diff, events)
+    def get(self, block=True, timeout=None):
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.diff or self.events, timeout if block else 0):
+                raise queue.Empty
+        time.sleep(self.window)
+        with self.cond:
+            diff, events = self.diff, list(self.events.values())
+            self.diff = {}
+            self.events = {}
+        return diff, events
+
+    def get_nowait(self):
+        return self.get(False)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+import os
+import logging
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
+
+
+if pygit2:
+    #pygit2 >= 1.14 moved the constants to pygit2.enums
+    CREDENTIAL_SSH_KEY = getattr(pygit2, "GIT_CREDENTIAL_SSH_KEY", None)
+    if CREDENTIAL_SSH_KEY is None:
+        CREDENTIAL_SSH_KEY = pygit2.enums.CredentialType.SSH_KEY
+
+    class RemoteCallbacks(pygit2.RemoteCallbacks):
+        def __init__(self):
+            super().__init__()
+            self.rejected = []
+            self.bytes_pushed = 0
+
+        def credentials(self, url, username_from_url, allowed_types):
+            if allowed_types & CREDENTIAL_SSH_KEY:
+                return pygit2.KeypairFromAgent(username_from_url or "git")
+            #https credential helpers are only supported by git itself
+            raise pygit2.GitError("no credentials for %s" % url)
+
+        def push_transfer_progress(self, objects_pushed, total_objects, bytes_pushed):
+            self.bytes_pushed = bytes_pushed
+
+        def push_update_reference(self, refname, message):
+            if message:
+                logger.warning("push rejected: %s %s", refname, message)
+                self.rejected.append(refname)
+
+
+#the author or committer of a commit like git: GIT_AUTHOR_NAME..., author.name..., user.name...,
+#None if git would guess it or GIT_AUTHOR_DATE... is set, repo.default_signature only reads user.name and user.email
+def get_signature(repo, who):
+    if "GIT_%s_DATE" % who.upper() in os.environ:
+        return None
+    config = repo.config
+    values = []
+    for field in ("name", "email"):
+        value = os.environ.get("GIT_%s_%s" % (who.upper(), field.upper()))
+        for key in ("%s.%s" % (who, field), "user.%s" % field):
+            if not value and key in config:
+                value = config[key]
+        if not value and field == "email":
+            value = os.environ.get("EMAIL")
+        if not value:
+            return None
+        values.append(value)
+    return pygit2.Signature(*values)
+
+
+#the git operations of sync.SubprocessEngine, run in process with libgit2
+#network errors (credentials, unsupported transports) fall back to the subprocess engine
+class Pygit2Engine(object):
+    name = "pygit2"
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+
+    @staticmethod
+    def available():
+        return pygit2 is not None
+
+    #libgit2 supports neither sparse checkout nor partial clone, those repos use git
+    def open(self, repo_path):
+        repo = pygit2.Repository(repo_path)
+        config = repo.config
+        for key in ("core.sparseCheckout", "extensions.partialClone", "remote.origin.promisor"):
+            if key in config and config[key] not in ("false", ""):
+                return None
+        return repo
+
+    def fetch(self, repo_path):
+        try:
+            repo = self.open(repo_path)
+            if repo is None:
+                return self.fallback.fetch(repo_path)
+            stats = repo.remotes["origin"].fetch(callbacks=RemoteCallbacks())
+            metrics.add(os.path.basename(repo_path), "bytes_received", stats.received_bytes)
+            return 0
+        except (pygit2.GitError, KeyError) as e:
+            logger.warning("pygit2 fetch error: %s", e)
+            return self.fallback.fetch(repo_path)
+
+    def status(self, repo_path):
+        try:
+            repo = self.open(repo_path)
+            if repo is None:
+                return self.fallback.status(repo_path)
+            status = repo.status()
+        except pygit2.GitError as e:
+            logger.warning("pygit2 status error: %s", e)
+            return 1, []
+        return 0, [path for path, flags in status.items() if flags != pygit2.GIT_STATUS_CURRENT and not flags & pygit2.GIT_STATUS_IGNORED]
+
+    def add_paths(self, repo_path, paths):
+        try:
+            repo = self.open(repo_path)
+            if repo is None:
+                return self.fallback.add_paths(repo_path, paths)
+            index = repo.index
+            for path in paths:
+                if os.path.lexists(os.path.join(repo_path, path)):
+                    index.add(path)
+                elif path in index:
+                    index.remove(path)
+            index.write()
+            return 0
+        except (pygit2.GitError, OSError) as e:
+            logger.warning("pygit2 add error: %s", e)
+            return 1
+
+    def commit(self, repo_path, message):
+        try:
+            repo = self.open(repo_path)
+            if repo is None:
+                return self.fallback.commit(repo_path, message)
+            index = repo.index
+            if index.conflicts is not None:
+                logger.warning("pygit2 commit error: unmerged files")
+                return 1
+            tree = index.write_tree()
+            parents = [] if repo.head_is_unborn else [repo.head.target]
+            mergeheads = repo.listall_mergeheads()
+            if not mergeheads and parents and repo[parents[0]].peel(pygit2.Commit).tree_id == tree:
+                #like git commit
+                logger.info("nothing to commit")
+                return 1
+            author = get_signature(repo, "author")
+            committer = get_signature(repo, "committer")
+            if author is None or committer is None:
+                #git commit guesses the identity from the user and the host name, or fails the same way
+                return self.fallback.commit(repo_path, message)
+            parents.extend(mergeheads)
+            repo.create_commit("HEAD", author, committer, message, tree, parents)
+            repo.state_cleanup()
+            return 0
+        except (pygit2.GitError, KeyError) as e:
+            logger.warning("pygit2 commit error: %s", e)
+            return 1
+
+    #same return codes as git merge: 1 conflicts left in the index, 2 the merge didn't start
+    def merge(self, repo_path, rev, message):
+        try:
+            repo = self.open(repo_path)
+            if repo is None:
+                return self.fallback.merge(repo_path, rev, message)
+            their = repo.revparse_single(rev).peel(pygit2.Commit)
+            analysis, _ = repo.merge_analysis(their.id)
+            if analysis & pygit2.GIT_MERGE_ANALYSIS_UP_TO_DATE:
+                logger.info("Already up to date.")
+                return 0
+            if analysis & pygit2.GIT_MERGE_ANALYSIS_FASTFORWARD:
+                repo.checkout_tree(their)
+                repo.head.set_target(their.id)
+                return 0
+
+            repo.merge(their.id)
+            if repo.index.conflicts is not None:
+                #MERGE_HEAD is kept, the caller resolves the conflicts and commits
+                return 1
+        except (pygit2.GitError, KeyError) as e:
+            #e.g. local changes would be overwritten, nothing to resolve
+            logger.warning("pygit2 merge error: %s", e)
+            return 2
+        return self.commit(repo_path, message)
+
+    def push(self, repo_path):
+        try:
+            repo = self.open(repo_path)
+            if repo is None:
+                return self.fallback.push(repo_path)
+            ref = repo.head.name
+            callbacks = RemoteCallbacks()
+            repo.remotes["origin"].push(["%s:%s" % (ref, ref)], callbacks=callbacks)
+            #libgit2 reports the bytes of a push over ssh, http or git://, always 0 to a local path,
+            #then the metric is left out rather than counted as 0
+            if callbacks.bytes_pushed:
+                metrics.add(os.path.basename(repo_path), "bytes_sent", callbacks.bytes_pushed)
+            return 1 if callbacks.rejected else 0
+        except (pygit2.GitError, KeyError) as e:
+            logger.warning("pygit2 push error: %s", e)
+            return self.fallback.push(repo_path)
+
+    def rev_parse(self, repo_path, revs):
+        try:
+            repo = self.open(repo_path)
+            if repo is None:
+                return self.fallback.rev_parse(repo_path, revs)
+            return [str(repo.revparse_single(rev).id) for rev in revs]
+        except (pygit2.GitError, KeyError) as e:
+            return None
+
+    def ls_files_unmerged(self, repo_path):
+        try:
+            repo = self.open(repo_path)
+            if repo is None:
+                return self.fallback.ls_files_unmerged(repo_path)
+            conflicts = repo.index.conflicts
+        except pygit2.GitError as e:
+            logger.warning("pygit2 ls-files error: %s", e)
+            return 1, []
+        entries = []
+        if conflicts is None:
+            return 0, entries
+        for conflict in conflicts:
+            for stage, entry in enumerate(conflict, 1):
+                if entry is not None:
+                    entries.append(("%06o" % entry.mode, str(entry.id), str(stage), entry.path))
+        return 0, entries
+
+    def cat_blobs(self, repo_path, blobs):
+        try:
+            repo = self.open(repo_path)
+            if repo is None:
+                return self.fallback.cat_blobs(repo_path, blobs)
+            for obj_id, filename in blobs:
+                with open(filename, "wb") as f:
+                    f.write(repo[obj_id].data)
+            return 0
+        except (pygit2.GitError, KeyError, OSError) as e:
+            logger.warning("pygit2 cat file error: %s", e)
+            return 1
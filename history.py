@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+import os
+import stat
+import sqlite3
+import logging
+from contextlib import contextmanager
+import config
+import sync
+from sync import subprocess, read_ref, conflicted_original
+from storage import write_atomic
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS commits(id INTEGER PRIMARY KEY, oid TEXT UNIQUE, time INTEGER, author TEXT, subject TEXT);
+CREATE TABLE IF NOT EXISTS versions(path TEXT, commit_id INTEGER, blob TEXT, mode TEXT, PRIMARY KEY(path, commit_id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS conflicts(copy TEXT PRIMARY KEY, original TEXT, host TEXT, date TEXT, commit_id INTEGER);
+CREATE INDEX IF NOT EXISTS conflicts_original ON conflicts(original);
+"""
+
+
+#the nul separated fields of git log -z, read as they come
+def read_fields(stream):
+    tail = b""
+    while True:
+        data = stream.read(64*1024)
+        if not data:
+            break
+        fields = (tail + data).split(b"\0")
+        tail = fields.pop()
+        yield from fields
+    if tail:
+        yield tail
+
+
+#path => the commits that changed it, and conflicted copy => original file, in a sqlite db in the .git directory
+#updated after each sync from the commits since the last indexed HEAD,
+#so listing the versions of a file never walks the history
+#the commits are numbered parents first, a higher id is a later version
+class History(object):
+    def db_path(self, repo_path):
+        return os.path.join(repo_path, ".git", config.HISTORY_DB)
+
+    #one connection per call, committed when the block succeeds, the index is used by the sync and the api threads
+    @contextmanager
+    def connect(self, repo_path):
+        db = sqlite3.connect(self.db_path(repo_path), timeout=30)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(SCHEMA)
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    #index the commits of HEAD that aren't indexed yet
+    #the index is rebuilt when the indexed tip is no longer in the history, e.g. after a reset
+    def update(self, repo_path):
+        head = read_ref(repo_path, "HEAD")
+        if not head:
+            return 1
+        with self.connect(repo_path) as db:
+            row = db.execute("SELECT value FROM meta WHERE key='tip'").fetchone()
+            tip = row[0] if row else None
+            if tip == head:
+                return 0
+            revs = [head]
+            if tip:
+                p = subprocess.Popen(["git", "merge-base", "--is-ancestor", tip, head], env=sync.env, cwd=repo_path)
+                if p.wait() == 0:
+                    revs.append("^" + tip)
+                else:
+                    logger.info("history rewritten, rebuild index: %s", repo_path)
+                    db.executescript("DELETE FROM versions; DELETE FROM conflicts; DELETE FROM commits;")
+            count = self.index_commits(db, repo_path, revs)
+            if count is None:
+                db.rollback()
+                return 1
+            db.execute("INSERT OR REPLACE INTO meta(key, value) VALUES('tip', ?)", (head,))
+        logger.info("history indexed: %s commits: %s", repo_path, count)
+        return 0
+
+    #the raw diff of every commit, and of a merge against each parent,
+    #a merge only adds the contents its parents don't have, like a conflicted copy
+    def index_commits(self, db, repo_path, revs):
+        argv = ["git", "log", "-m", "--raw", "--no-renames", "--no-abbrev", "-z", "--date-order", "--reverse",
+                "--format=%x01%H%x00%P%x00%at%x00%an%x00%s"] + revs
+        p = subprocess.Popen(argv, stdout=subprocess.PIPE, env=sync.env, cwd=repo_path)
+        fields = read_fields(p.stdout)
+        try:
+            count = self.index_fields(db, fields)
+        finally:
+            #a failed insert stops git log with a broken pipe
+            p.stdout.close()
+            r = p.wait()
+        if r != 0:
+            logger.warning("history log error: %s %s", repo_path, r)
+            return None
+        return count
+
+    def index_fields(self, db, fields):
+        count = 0
+        oid = None
+        commit_id = None
+        merge = False
+        for field in fields:
+            field = field.lstrip(b"\n")
+            if field.startswith(b"\x01"):
+                parents = next(fields).split()
+                at = int(next(fields))
+                author = next(fields).decode("utf8", "replace")
+                subject = next(fields).decode("utf8", "replace")
+                if field[1:].decode() == oid:
+                    #the same merge against the next parent
+                    continue
+                oid = field[1:].decode()
+                merge = len(parents) > 1
+                commit_id = db.execute("INSERT INTO commits(oid, time, author, subject) VALUES(?, ?, ?, ?)", (oid, at, author, subject)).lastrowid
+                count += 1
+            elif field.startswith(b":"):
+                _, mode, _, blob, status = field.decode().split(" ")
+                path = next(fields).decode("utf8", "replace")
+                if status == "D":
+                    if merge:
+                        continue
+                    blob, mode = None, None
+                elif merge and db.execute("SELECT 1 FROM versions WHERE path=? AND blob=?", (path, blob)).fetchone():
+                    continue
+                db.execute("INSERT OR REPLACE INTO versions(path, commit_id, blob, mode) VALUES(?, ?, ?, ?)", (path, commit_id, blob, mode))
+                if status == "A":
+                    m = conflicted_original(path)
+                    if m:
+                        db.execute("INSERT OR IGNORE INTO conflicts(copy, original, host, date, commit_id) VALUES(?, ?, ?, ?, ?)", (path,) + m + (commit_id,))
+        return count
+
+    #the versions of the file, latest first, a deleted version has no blob
+    def versions(self, repo_path, path, limit=config.HISTORY_LIMIT):
+        with self.connect(repo_path) as db:
+            rows = db.execute("SELECT c.oid, c.time, c.author, c.subject, v.blob, v.mode FROM versions v JOIN commits c ON c.id = v.commit_id "
+                              "WHERE v.path=? ORDER BY v.commit_id DESC LIMIT ?", (path, limit)).fetchall()
+        return [{"commit":oid, "time":time, "author":author, "message":subject, "blob":blob, "deleted":blob is None}
+                for oid, time, author, subject, blob, mode in rows]
+
+    #the conflicted copies of the file, or of every file, and whether they are still in the worktree
+    def conflicted_copies(self, repo_path, path=None):
+        with self.connect(repo_path) as db:
+            sql = "SELECT x.copy, x.original, x.host, x.date, c.oid, c.time FROM conflicts x JOIN commits c ON c.id = x.commit_id"
+            if path is None:
+                rows = db.execute(sql + " ORDER BY x.commit_id DESC").fetchall()
+            else:
+                rows = db.execute(sql + " WHERE x.original=? ORDER BY x.commit_id DESC", (path,)).fetchall()
+        return [{"path":copy, "original":original, "host":host, "date":date, "commit":oid, "time":time,
+                 "exists":os.path.lexists(os.path.join(repo_path, copy))}
+                for copy, original, host, date, oid, time in rows]
+
+    #write the version of the file at the commit into the worktree, the next sync commits it
+    def restore(self, repo_path, path, commit):
+        with self.connect(repo_path) as db:
+            row = db.execute("SELECT v.blob, v.mode FROM versions v JOIN commits c ON c.id = v.commit_id "
+                             "WHERE v.path=? AND c.oid=?", (path, commit)).fetchone()
+        if not row or not row[0]:
+            logger.warning("no version to restore: %s %s %s", repo_path, path, commit)
+            return 1
+        blob, mode = row
+        #with the smudge and eol filters of a checkout
+        p = subprocess.Popen(["git", "cat-file", "--filters", "--path=%s" % path, blob], stdout=subprocess.PIPE, env=sync.ssh_env(repo_path), cwd=repo_path)
+        data, _ = p.communicate()
+        if p.returncode != 0:
+            logger.warning("cat-file error: %s %s", blob, p.returncode)
+            return p.returncode
+        filename = os.path.join(repo_path, path)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        if mode == "120000":
+            if os.path.lexists(filename):
+                os.remove(filename)
+            os.symlink(os.fsdecode(data), filename)
+            return 0
+        if os.path.islink(filename):
+            os.remove(filename)
+        write_atomic(filename, data)
+        if mode == "100755":
+            os.chmod(filename, os.stat(filename).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        return 0
@@ -9,7 +9,7 @@ ReactDOM.render(
     document.getElementById('root')
 );
 
-function updateRepoState(repoName, lastSyncTime, syncing, syncResult) {
-    root.updateRepoState(repoName, lastSyncTime, syncing, syncResult);
+function applyRepoDiff(diff) {
+    root.applyRepoDiff(diff);
 }
-window.updateRepoState = updateRepoState;
\ No newline at end of file
+window.applyRepoDiff = applyRepoDiff;
\ No newline at end of file
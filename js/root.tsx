@@ -8,9 +8,13 @@ interface Repository {
     url:string;
     disabled:boolean;//不再自动同步
     rdonly:boolean;//本地更新不自动同步到服务器
+    shallow?:boolean;//只保留最近的提交历史
+    folders?:string[];//只同步这些目录, 为空时同步整个仓库
     lastSyncTime?:number;
+    nextSyncTime?:number;
     syncing?:boolean;
     syncResult?:boolean;
+    progress?:number;//克隆进度百分比, 不在克隆时为null
 }
 
 
@@ -153,20 +157,32 @@ function Setting(props) {
 function Add(props) {
     const [isOpen, setIsOpen] = useState(false);
     const [repoUrl, setRepoUrl] = useState("");
+    const [shallow, setShallow] = useState(false);
+    const [folders, setFolders] = useState("");
     var onCancel = function() {
         setIsOpen(false);
     }
 
     var onOk = function() {
-        props.onAdd(repoUrl)
+        props.onAdd(repoUrl, shallow, parseFolders(folders))
             .then((r) => {
                 if (r) {
                     setIsOpen(false);
                     setRepoUrl("");
+                    setShallow(false);
+                    setFolders("");
                 }
             });
     }
 
+    var onShallowChange = function(event) {
+        setShallow(event.currentTarget.checked);
+    }
+
+    var onFoldersChange = function(event) {
+        setFolders(event.currentTarget.value);
+    }
+
     var onChange = function(event) {
         setRepoUrl(event.currentTarget.value);
     }
@@ -182,6 +198,11 @@ function Add(props) {
                 <div className={styles["modal-content"]}>
                     <h2>新仓库</h2>
                     <input value={repoUrl} onChange={onChange} placeholder={"仓库URL"} />
+                    <label>
+                        <input type="checkbox" checked={shallow} onChange={onShallowChange} />
+                        <span>浅克隆</span>
+                    </label>
+                    <textarea value={folders} onChange={onFoldersChange} placeholder={"同步目录, 每行一个, 为空时同步整个仓库"} />
                     <div className={styles["bottom"]}>
                         <button onClick={onCancel}>取消</button>
                         <button onClick={onOk}>确定</button>
@@ -192,6 +213,58 @@ function Add(props) {
     );
 }
 
+//每行一个目录
+function parseFolders(text:string):string[]|null {
+    var folders = text.split("\n")
+        .map((folder) => folder.trim().replace(/^\/+|\/+$/g, ""))
+        .filter((folder) => !!folder);
+    return folders.length > 0 ? folders : null;
+}
+
+function Folders(props) {
+    const [isOpen, setIsOpen] = useState(false);
+    const [text, setText] = useState("");
+
+    var onOpen = function() {
+        setText((props.repo.folders || []).join("\n"));
+        setIsOpen(true);
+    }
+
+    var onCancel = function() {
+        setIsOpen(false);
+    }
+
+    var onOk = function() {
+        props.onApply(props.repo.name, parseFolders(text))
+            .then((r) => {
+                if (r) {
+                    setIsOpen(false);
+                }
+            });
+    }
+
+    var onChange = function(event) {
+        setText(event.currentTarget.value);
+    }
+
+    return (
+        <span>
+            <button onClick={onOpen}>同步目录</button>
+            <Modal
+                isOpen={isOpen}>
+                <div className={styles["modal-content"]}>
+                    <h2>同步目录</h2>
+                    <textarea value={text} onChange={onChange} placeholder={"每行一个目录, 为空时同步整个仓库"} />
+                    <div className={styles["bottom"]}>
+                        <button onClick={onCancel}>取消</button>
+                        <button onClick={onOk}>确定</button>
+                    </div>
+                </div>
+            </Modal>
+        </span>
+    );
+}
+
 const Checkbox = props => (
     <input type="checkbox" {...props} />
 )
@@ -224,6 +297,8 @@ export class Root extends React.Component<Props, Stat> {
         this.onSync = this.onSync.bind(this);
         this.onDelete = this.onDelete.bind(this);
         this.onCheckboxChange = this.onCheckboxChange.bind(this);
+        this.onShallowChange = this.onShallowChange.bind(this);
+        this.onApplyFolders = this.onApplyFolders.bind(this);
 
         this.refreshState = this.refreshState.bind(this);
         this.onApiReady = this.onApiReady.bind(this);
@@ -260,23 +335,21 @@ export class Root extends React.Component<Props, Stat> {
             });
     }
 
-    updateRepoState(repoName, lastSyncTime, syncing, syncResult) {
-        var repo = this.state.repositories.find((repo) => {
-            return repo.name == repoName;
+    //{name:{lastSyncTime, nextSyncTime, syncing, syncResult, progress}}, only the changed fields
+    applyRepoDiff(diff) {
+        console.log("apply repo diff:", diff);
+        var repositories = this.state.repositories.map((repo) => {
+            var fields = diff[repo.name];
+            if (!fields) {
+                return repo;
+            }
+            return Object.assign({}, repo, fields);
         });
-        if (!repo) {
-            console.log("can't find repo:", repoName);
-            return;
-        }
-        console.log("update repo state:", repoName, lastSyncTime, syncing);
-        repo.lastSyncTime = lastSyncTime;
-        repo.syncResult = syncResult;
-        repo.syncing = syncing;
-        this.setState({});
+        this.setState({repositories:repositories});
     }
  
 
-    onAddRepo(repo_url) {
+    onAddRepo(repo_url, shallow, folders) {
         var p = Promise.resolve(false);
         if (!repo_url) {
             return p;
@@ -302,8 +375,8 @@ export class Root extends React.Component<Props, Stat> {
             return p;
         }
 
-        var repo:Repository = {name:name, url:repo_url, disabled:false, rdonly:false};
-        return window.pywebview.api.add_repo(name, repo_url)
+        var repo:Repository = {name:name, url:repo_url, disabled:false, rdonly:false, shallow:shallow, folders:folders};
+        return window.pywebview.api.add_repo(name, repo_url, shallow, folders)
             .then((r) => {
                 if (r) {
                     this.state.repositories.push(repo);
@@ -356,6 +429,43 @@ export class Root extends React.Component<Props, Stat> {
         this.setState({});
     }
 
+    onShallowChange(e) {
+        var name = e.target.dataset.name;
+        var checked = e.target.checked;
+        if (!name) {
+            return;
+        }
+        console.log("shallow repo:", name, checked);
+
+        window.pywebview.api.set_repo_shallow(name, checked)
+
+        var repos = this.state.repositories;
+        var repo = repos.find((repo) => {
+            return repo.name == name;
+        });
+        if (!repo) {
+            console.log("can't find repo:", name);
+            return;
+        }
+        repo.shallow = checked;
+        this.setState({});
+    }
+
+    onApplyFolders(name, folders) {
+        console.log("repo folders:", name, folders);
+        return window.pywebview.api.set_repo_folders(name, folders)
+            .then((r) => {
+                var repo = this.state.repositories.find((repo) => {
+                    return repo.name == name;
+                });
+                if (r && repo) {
+                    repo.folders = folders;
+                    this.setState({});
+                }
+                return r;
+            });
+    }
+
     onSync(e) {
         var name = e.target.dataset.name;
         console.log("sync repo:", name);
@@ -383,7 +493,9 @@ export class Root extends React.Component<Props, Stat> {
         var repos = this.state.repositories;
         repos.forEach((repo) => {
             var status = "";
-            if (repo.syncing) {
+            if (repo.syncing && repo.progress != null) {
+                status = "正在克隆 " + repo.progress + "%";
+            } else if (repo.syncing) {
                 status = "正在同步"
             } else if (repo.lastSyncTime) {
                 if (repo.syncResult === false) {
@@ -409,7 +521,16 @@ export class Root extends React.Component<Props, Stat> {
                                 />
                           <span>自动同步</span>
                         </label>
+                        <label>
+                            <Checkbox
+                                data-name={repo.name}
+                                checked={!!repo.shallow}
+                                onChange={this.onShallowChange}
+                                />
+                          <span>浅克隆</span>
+                        </label>
                         <div>
+                            <Folders repo={repo} onApply={this.onApplyFolders} />
                             <button  onClick={this.onSync} data-name={repo.name}>同步仓库</button>
                             <button  onClick={this.onDelete} data-name={repo.name}>移除仓库</button>
                         </div>
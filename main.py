@@ -2,54 +2,47 @@
 import sys
 import os
 import time
+#cold start is measured from here
+START_TIME = time.monotonic()
 import json
+import signal
+import logging
 import subprocess
-import webview
+import argparse
 from pathlib import Path
 from sync import Sync
 from sync import set_env_path
+from sync import set_ssh_control_dir
+from sync import set_merge_engine
+from sync import set_git_engine
+from sync import set_commit_coalescing
+from sync import set_parallel_hash
 from sync import WAKEUP
+from sync import subprocess as git_tracer
+from eventbus import EventBus
+from storage import Store
+from control import ControlServer
+from metrics import metrics
 import appdirs
 import threading, queue
 import config
 
-APPNAME = "gitcloud"
+APPNAME = config.APPNAME
 
 sync_q = queue.Queue(maxsize=1000)
-event_q = queue.Queue(maxsize=1000)
+event_q = EventBus()
 
 sync = None
-
-def read_json(path, default):
-    try:
-        with open(path, "rb") as f:
-            data = f.read()
-            if not data:
-                return default
-            obj = json.loads(data.decode("utf8"))
-            return obj
-    except FileNotFoundError as e:
-        return default
-
-def read_repo_db(workspace):
-    path = os.path.join(workspace, ".repos")
-    return read_json(path, [])
-
-def write_repo_db(workspace, repos):
-    path = os.path.join(workspace, ".repos")
-    with open(path, "wb") as f:
-        data = json.dumps(repos)
-        f.write(data.encode("utf8"))
+setting_store = None
 
 def read_setting_db():
-    path = os.path.join(appdirs.user_data_dir(APPNAME), "setting.json")
-    return read_json(path, {})
+    global setting_store
+    setting_store = Store(os.path.join(appdirs.user_data_dir(APPNAME), "setting.json"))
+    setting_store.start()
+    return setting_store.load({})
 
 def write_setting_db(setting):
-    path = os.path.join(appdirs.user_data_dir(APPNAME), "setting.json")
-    with open(path, "wb") as f:
-        data = json.dumps(setting)
-        f.write(data.encode("utf8"))
+    setting_store.save(setting)
 
 
 def createExcludesFile(ignore_file):
@@ -72,28 +65,88 @@ def createExcludesFile(ignore_file):
         if ignores:
             f.write("\n".encode("utf8"))
 
+#the incompressible types are stored without delta compression and never diffed
+def createAttributesFile(attributes_file):
+    attributes = ["*.%s -delta -diff" % ext for ext in config.BINARY_EXTENSIONS]
+    try:
+        with open(attributes_file, "r", encoding="utf8") as f:
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                line = line.rstrip()
+                attributes = [attribute for attribute in attributes if attribute != line]
+    except OSError as e:
+        pass
+
+    with open(attributes_file, "ab") as f:
+        for attribute in attributes:
+            f.write(("\n%s"%attribute).encode("utf8"))
+        if attributes:
+            f.write("\n".encode("utf8"))
+
+#["docs/", " /photos/2020 "] => ["docs", "photos/2020"], None if no folder
+def normalize_folders(folders):
+    if not folders:
+        return None
+    folders = [folder.strip().strip("/") for folder in folders]
+    folders = [folder for folder in folders if folder]
+    return folders or None
+
+#the mirror urls without blanks, duplicates and the primary url
+def normalize_mirrors(mirrors, url):
+    result = []
+    for mirror in mirrors or []:
+        mirror = mirror.strip()
+        if mirror and mirror != url and mirror not in result:
+            result.append(mirror)
+    return result
+
+
 class Api():
     def __init__(self, setting):
         self.workspace = setting["workspace"]
         self.setting = setting
-        self.dirty = False
         self.lock = threading.Lock()
-        self.repos = read_repo_db(self.workspace)
+        #the writes are done by the store thread, never under self.lock
+        self.store = Store(os.path.join(self.workspace, ".repos"))
+        self.repos = self.store.load([])
+        #name => syncing, syncResult and progress of the repo
+        self.states = {}
+        #seconds from process start to ready
+        self.startup = None
         self.window = None
 
-    def update_last_sync_time(self, repo_name):
+    #apply a sync state diff, return the fields of the known repos for the ui
+    def update_repo_state(self, diff):
+        changes = {}
         with self.lock:
             for repo in self.repos:
-                if repo["name"] == repo_name:
-                    repo["lastSyncTime"] = int(time.time())
-                    self.dirty = True
-                    break
+                fields = diff.get(repo["name"])
+                if not fields:
+                    continue
+                times = {key:fields[key] for key in ("lastSyncTime", "nextSyncTime") if key in fields}
+                if times:
+                    repo.update(times)
+                    self.store.update(repo["name"], times)
+                change = {key:fields[key] for key in ("lastSyncTime", "nextSyncTime", "syncing", "progress") if key in fields}
+                if "result" in fields:
+                    change["syncResult"] = bool(fields["result"])
+                changes[repo["name"]] = change
+                self.states.setdefault(repo["name"], {}).update((key, change[key]) for key in ("syncing", "syncResult", "progress") if key in change)
+        return changes
 
     def get_repos(self):
         print("js api thread id:", threading.get_ident())
         with self.lock:
             return [repo.copy() for repo in self.repos]
     
+    #the repos with their sync state, for the control clients
+    def status(self):
+        with self.lock:
+            repos = [dict(repo, **self.states.get(repo["name"], {})) for repo in self.repos]
+            return {"workspace":self.workspace, "interval":self.setting["interval"], "startup":self.startup, "repos":repos}
+
     def get_setting(self):
         with self.lock:
             return self.setting.copy()
@@ -110,11 +163,11 @@ class Api():
             sync_q.put_nowait(WAKEUP)
             return True
 
-    def add_repo(self, name, url):
+    def add_repo(self, name, url, shallow=False, folders=None, mirrors=None):
         with self.lock:
-            return self._add_repo(name, url)
+            return self._add_repo(name, url, shallow, folders, mirrors)
 
-    def _add_repo(self, name, url):
+    def _add_repo(self, name, url, shallow=False, folders=None, mirrors=None):
         pos = -1
         for index, repo in enumerate(self.repos):
             if repo["name"] == name:
@@ -124,10 +177,18 @@ class Api():
             return False
 
         repo = {"name":name, "url":url, "disabled":False, "rdonly":False}
+        if shallow:
+            repo["shallow"] = True
+            repo["depth"] = config.SHALLOW_DEPTH
+        folders = normalize_folders(folders)
+        if folders is not None:
+            repo["folders"] = folders
+        mirrors = normalize_mirrors(mirrors, url)
+        if mirrors:
+            repo["mirrors"] = mirrors
         print("add repo:", repo)
         self.repos.append(repo)
-        write_repo_db(self.workspace, self.repos)
-        self.dirty = False
+        self.store.save(self.repos)
         sync_q.put(repo)
         return True
 
@@ -146,11 +207,106 @@ class Api():
             rs = [repo for repo in self.repos if repo["name"] == name]
             if rs:
                 rs[0]["disabled"] = not auto_sync
-                write_repo_db(self.workspace, self.repos)
+                self.store.save(self.repos)
                 sync_q.put_nowait(rs[0])
                 print("put sync:", rs[0])
 
 
+    #shallow repos keep only the recent history, pruned by the maintenance job
+    def set_repo_shallow(self, name, shallow):
+        print("shallow repo:", name, shallow)
+        with self.lock:
+            rs = [repo for repo in self.repos if repo["name"] == name]
+            if not rs:
+                return False
+            rs[0]["shallow"] = bool(shallow)
+            rs[0].setdefault("depth", config.SHALLOW_DEPTH)
+            self.store.save(self.repos)
+            sync_q.put_nowait(rs[0].copy())
+            return True
+
+    #selective sync, only the folders are fetched and checked out, empty syncs everything
+    def set_repo_folders(self, name, folders):
+        print("repo folders:", name, folders)
+        with self.lock:
+            rs = [repo for repo in self.repos if repo["name"] == name]
+            if not rs:
+                return False
+            rs[0]["folders"] = normalize_folders(folders)
+            self.store.save(self.repos)
+            sync_q.put_nowait(rs[0].copy())
+            return True
+
+    #the other remotes the repo is pushed to after each sync
+    def set_repo_mirrors(self, name, mirrors):
+        print("repo mirrors:", name, mirrors)
+        with self.lock:
+            rs = [repo for repo in self.repos if repo["name"] == name]
+            if not rs:
+                return False
+            rs[0]["mirrors"] = normalize_mirrors(mirrors, rs[0]["url"])
+            self.store.save(self.repos)
+            sync_q.put_nowait(rs[0].copy())
+            return True
+
+    #health, lag and backoff of the mirrors of the repos
+    def get_mirrors(self):
+        with self.lock:
+            names = [repo["name"] for repo in self.repos if repo.get("mirrors")]
+        return {name:sync.mirrors.status(name) for name in names}
+
+    #sync timings and counters per repo, see metrics.Metrics.stats
+    def get_stats(self):
+        return metrics.stats()
+
+    #the last maintenance of the repos, with the objects, packs and git status seconds before and after
+    def get_maintenance(self):
+        with self.lock:
+            names = [repo["name"] for repo in self.repos]
+        return {name:sync.copy_state(name, "maintenance") for name in names}
+
+    #repo path and file path of a repo file, None if the repo or the history index is missing
+    def history_path(self, name, path):
+        with self.lock:
+            if not sync.history or not any(repo["name"] == name for repo in self.repos):
+                return None
+        repo_path = os.path.join(self.workspace, name)
+        path = os.path.normpath(path).replace(os.sep, "/") if path is not None else None
+        if path is not None and (os.path.isabs(path) or path == ".." or path.startswith("../")):
+            return None
+        if not os.path.exists(sync.history.db_path(repo_path)):
+            return None
+        return repo_path, path
+
+    #the versions of a file from the history index, latest first
+    def get_file_versions(self, name, path, limit=config.HISTORY_LIMIT):
+        r = self.history_path(name, path)
+        if not r:
+            return None
+        return sync.history.versions(r[0], r[1], int(limit))
+
+    #the conflicted copies of a file, of every file if path is None
+    def get_conflicted_copies(self, name, path=None):
+        r = self.history_path(name, path)
+        if not r:
+            return None
+        return sync.history.conflicted_copies(*r)
+
+    #write a version of the file into the worktree, and sync it
+    def restore_file_version(self, name, path, commit):
+        print("restore file:", name, path, commit)
+        r = self.history_path(name, path)
+        if not r or path is None:
+            return False
+        if sync.history.restore(r[0], r[1], commit) != 0:
+            return False
+        self.sync_repo(name)
+        return True
+
+    #the last git invocations, see sync.LogSubProcess
+    def get_traces(self, limit=100):
+        return git_tracer.get_traces(int(limit))
+
     def delete_repo(self, name):
         print("del repo:", name)
         with self.lock:
@@ -158,66 +314,54 @@ class Api():
             if rs:
                 repo = rs[1].copy()
                 self.repos.pop(rs[0])
+                self.states.pop(name, None)
                 repo["disabled"] = True
-                write_repo_db(self.workspace, self.repos)
+                repo["deleted"] = True
+                self.store.save(self.repos)
                 sync_q.put_nowait(repo)
 
 
-    def get_sync_event(self):
-        try:
-            item = event_q.get(timeout=60)
-            print("sync event:", item)
-            event = item["event"]
-            if event == "repo_begin":
-                self.update_last_sync_time(item["name"])
-            if event == "end":
-                self.save_dirty_repo_db()
-
-            if event == "repo_begin" or event == "repo_end":
-                return item
-            return None
-        except queue.Empty as e:
-            print("queue empty exception")
-            return None
-
-
-    def save_dirty_repo_db(self):
-        with self.lock:
-            if not self.dirty:
-                return
-            write_repo_db(self.workspace, self.repos)
+    #the events of one frame window, merged by the event bus
+    def get_sync_diff(self):
+        diff, events = event_q.get()
+        print("sync events:", diff, events)
+        return self.update_repo_state(diff)
 
     def run(self):
         while True:
-            event = self.get_sync_event()
-            if not event:
-                continue
-            repo_name = event["name"]
-            rs = [repo for repo in self.repos if repo["name"] == repo_name]
-            if not rs:
+            changes = self.get_sync_diff()
+            if not changes or not self.window:
                 continue
-            last_sync_time = rs[0]["lastSyncTime"]
-            syncing = "true" if event["event"] == "repo_begin" else "false"
-            sync_result = "true" if event.get("result", True) else "false"
-            self.window.evaluate_js("updateRepoState(\"%s\", %s, %s, %s)"%(event["name"], last_sync_time, syncing, sync_result))
+            self.window.evaluate_js("applyRepoDiff(%s)" % json.dumps(changes))
 
     def start(self):
+        self.store.start()
         thread = threading.Thread(target=self.run, daemon=True, args=())
         thread.start()
     
 
 def main():
     global sync
+    #the sync threads log to stderr
+    logging.basicConfig(level=logging.DEBUG if config.DEBUG else logging.INFO, format="%(asctime)s %(threadName)s %(name)s %(levelname)s: %(message)s")
     print(sys.argv)
-    url = "index.html"
-    if len(sys.argv) > 1:
-        url = sys.argv[1]
+    parser = argparse.ArgumentParser(description="git cloud")
+    parser.add_argument("url", nargs="?", default="index.html")
+    parser.add_argument("--headless", action="store_true", help="run without the window, control it with control.py")
+    args, _ = parser.parse_known_args()
+    url = args.url
     print("main thread id:", threading.get_ident())
 
     data_dir = appdirs.user_data_dir(APPNAME)
     if not os.path.exists(data_dir):
         os.mkdir(data_dir)
 
+    #before the stores and the sync threads start
+    control = None
+    if ControlServer.available():
+        control = ControlServer(None, os.path.join(data_dir, config.CONTROL_SOCKET))
+        control.bind()
+
     setting = read_setting_db()
     if not setting:
         setting = {
@@ -228,6 +372,9 @@ def main():
     excludesFile = os.path.join(appdirs.user_data_dir(APPNAME), ".gitignore")
     createExcludesFile(excludesFile)
     print("excludesFile:", excludesFile)
+    attributesFile = os.path.join(appdirs.user_data_dir(APPNAME), ".gitattributes")
+    createAttributesFile(attributesFile)
+    print("attributesFile:", attributesFile)
 
     workspace = setting["workspace"]
     if not os.path.exists(workspace):
@@ -241,18 +388,79 @@ def main():
         else:
             env_path = path
         set_env_path(env_path)
+
+    set_ssh_control_dir(os.path.expanduser(config.SSH_CONTROL_DIR))
+
+    if setting.get("trace_file"):
+        git_tracer.set_trace_file(setting["trace_file"])
+    set_merge_engine(setting.get("merge_engine", "worktree"))
+    set_git_engine(setting.get("git_engine", "subprocess"))
+    set_commit_coalescing(setting.get("commit_quiet", 0), setting.get("commit_max_delay", config.COMMIT_MAX_DELAY), setting.get("squash_push", False))
+    set_parallel_hash(setting.get("parallel_hash", False))
         
     api = Api(setting)
     repos = [repo.copy() for repo in api.repos]
-    sync = Sync(repos, event_q, setting["interval"], excludesFile)
-
-    window = webview.create_window('gitCloud', url, width=400, height=680, js_api=api)
-    api.window = window
+    workers = setting.get("workers", config.SYNC_WORKERS)
+    host_workers = setting.get("host_workers", config.SYNC_HOST_WORKERS)
+    watch = setting.get("watch", False)
+    #"thread": a worker thread per syncing repo, "async": one event loop, see aiosync
+    sync_class = Sync
+    if setting.get("sync_engine") == "async":
+        from aiosync import AsyncSync
+        sync_class = AsyncSync
+    sync = sync_class(repos, event_q, setting["interval"], excludesFile, workers, host_workers, watch)
+    sync.attributesFile = attributesFile
+    if setting.get("shared_objects"):
+        from objectcache import ObjectCache
+        sync.object_cache = ObjectCache(os.path.join(data_dir, config.SHARED_OBJECTS))
+    if setting.get("history", True):
+        from history import History
+        sync.history = History()
+
+    if not args.headless:
+        #the gui toolkit is slow to import, the daemon never loads it
+        import webview
+        window = webview.create_window('gitCloud', url, width=400, height=680, js_api=api)
+        api.window = window
 
     api.start()
     sync.start(sync_q, workspace)
 
-    webview.start(debug=config.DEBUG)    
+    if control:
+        control.api = api
+        control.start()
+        print("control socket:", control.path)
+
+    if setting.get("webhook"):
+        from webhook import Webhook
+        port = setting.get("webhook_port", config.WEBHOOK_PORT)
+        webhook = Webhook(sync, port, setting.get("webhook_secret"))
+        webhook.start()
+        sync.poll_interval = setting.get("webhook_poll_interval", config.WEBHOOK_POLL_INTERVAL)
+        print("webhook listen:", port)
+
+    if setting.get("metrics"):
+        from metrics import MetricsServer
+        port = setting.get("metrics_port", config.METRICS_PORT)
+        MetricsServer(port).start()
+        print("metrics listen:", port)
+
+    api.startup = time.monotonic() - START_TIME
+    print("startup: %.3fs" % api.startup)
+
+    if args.headless:
+        stopped = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: stopped.set())
+        #wake up now and then, the signal handlers run on the main thread
+        while not stopped.wait(1):
+            pass
+    else:
+        webview.start(debug=config.DEBUG)
+    if control:
+        control.close()
+    api.store.flush()
+    setting_store.flush()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import time
+import zlib
+import shutil
+import threading
+import logging
+import config
+import sync
+from sync import subprocess, read_ref, update_state
+from storage import write_atomic
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+#cut the history back to depth commits and drop the objects no longer reachable
+#only when HEAD is the remote tip, so no local commit can be lost
+def prune_shallow(repo_path, branch, depth):
+    head = read_ref(repo_path, "HEAD")
+    if not head or head != read_ref(repo_path, "refs/remotes/origin/%s" % branch):
+        logger.warning("repo has unpushed commits, skip prune: %s", repo_path)
+        return 1
+
+    cwd = repo_path
+    p = subprocess.Popen(["git", "fetch", "--depth", str(depth), "origin", branch], env=sync.ssh_env(cwd), cwd=cwd)
+    r = p.wait()
+    if r != 0:
+        logger.warning("shallow fetch error: %s", r)
+        return r
+    p = subprocess.Popen(["git", "reflog", "expire", "--expire=now", "--all"], env=sync.env, cwd=cwd)
+    r = p.wait()
+    if r != 0:
+        logger.warning("reflog expire error: %s", r)
+        return r
+    p = subprocess.Popen(["git", "gc", "--quiet", "--prune=now"], env=sync.env, cwd=cwd)
+    r = p.wait()
+    if r != 0:
+        logger.warning("gc error: %s", r)
+    return r
+
+
+#git count-objects -v => {"count":loose objects, "packs":pack files, ...}, None if error
+def count_objects(repo_path):
+    p = subprocess.Popen(["git", "count-objects", "-v"], stdout=subprocess.PIPE, env=sync.env, cwd=repo_path, text=True)
+    out, _ = p.communicate()
+    if p.returncode != 0:
+        return None
+    counts = {}
+    for line in out.split("\n"):
+        key, _, value = line.partition(":")
+        if value.strip().isdigit():
+            counts[key] = int(value)
+    return counts
+
+#seconds of a git status, every sync pays it
+def time_status(repo_path):
+    begin = time.monotonic()
+    p = subprocess.Popen(["git", "status", "--porcelain", "--untracked-files=all"], stdout=subprocess.DEVNULL, env=sync.env, cwd=repo_path)
+    p.wait()
+    return time.monotonic() - begin
+
+#the untracked cache, and the builtin fsmonitor where git has one, make git status cheaper
+#the repos cloned before the attributes file existed get it too
+def tune_repo(repo_path, version, attributes_file=None):
+    options = [("core.untrackedCache", "true")]
+    if attributes_file:
+        options.append(("core.attributesFile", attributes_file))
+    if version >= (2, 36) and sys.platform in ("darwin", "win32"):
+        options.append(("core.fsmonitor", "true"))
+    for key, value in options:
+        p = subprocess.Popen(["git", "config", key, value], env=sync.env, cwd=repo_path)
+        r = p.wait()
+        if r != 0:
+            logger.warning("config error: %s", r)
+            return r
+    return 0
+
+#extension => {"bytes", "samples":a few paths of at least 1KB} of the checked out and the new files, None if error
+def scan_extensions(repo_path):
+    p = subprocess.Popen(["git", "ls-files", "-z", "--cached", "--others", "--exclude-standard"], stdout=subprocess.PIPE, env=sync.env, cwd=repo_path, text=True)
+    out, _ = p.communicate()
+    if p.returncode != 0:
+        return None
+    extensions = {}
+    for path in out.split("\0"):
+        ext = os.path.splitext(path)[1][1:].lower()
+        #no pattern for the files without extension
+        if not re.fullmatch(r"[\w-]+", ext):
+            continue
+        try:
+            size = os.lstat(os.path.join(repo_path, path)).st_size
+        except OSError as e:
+            continue
+        e = extensions.setdefault(ext, {"bytes":0, "samples":[]})
+        e["bytes"] += size
+        if size >= 1024 and len(e["samples"]) < 3:
+            e["samples"].append(path)
+    return extensions
+
+#zlib shrinks the start of the file less than BINARY_RATIO
+def incompressible(path):
+    try:
+        with open(path, "rb") as f:
+            data = f.read(config.BINARY_SAMPLE_SIZE)
+    except OSError as e:
+        return False
+    return len(data) > 0 and len(zlib.compress(data, 1)) >= len(data) * config.BINARY_RATIO
+
+#return (incompressible extensions not in BINARY_EXTENSIONS, share of the incompressible bytes), None if error
+def classify_repo(repo_path):
+    extensions = scan_extensions(repo_path)
+    if extensions is None:
+        return None
+    found = []
+    binary = total = 0
+    for ext, e in sorted(extensions.items()):
+        total += e["bytes"]
+        if ext in config.BINARY_EXTENSIONS:
+            binary += e["bytes"]
+        elif e["samples"] and all(incompressible(os.path.join(repo_path, path)) for path in e["samples"]):
+            found.append(ext)
+            binary += e["bytes"]
+    return found, binary/total if total else 0
+
+ATTRIBUTES_BEGIN = "#begin git cloud binary types"
+ATTRIBUTES_END = "#end git cloud binary types"
+
+#the binary types found in the repo, in a managed block of .git/info/attributes
+#the user's lines around the block are kept
+def write_info_attributes(repo_path, extensions):
+    path = os.path.join(repo_path, ".git", "info", "attributes")
+    try:
+        with open(path, "r", encoding="utf8") as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError as e:
+        lines = []
+    keep = []
+    managed = False
+    for line in lines:
+        if line == ATTRIBUTES_BEGIN:
+            managed = True
+        elif line == ATTRIBUTES_END:
+            managed = False
+        elif not managed:
+            keep.append(line)
+    if extensions:
+        keep += [ATTRIBUTES_BEGIN] + ["*.%s -delta -diff" % ext for ext in extensions] + [ATTRIBUTES_END]
+    if keep == lines:
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_atomic(path, "".join(line + "\n" for line in keep).encode("utf8"))
+
+#fast zlib and no delta for the big files of a binary heavy repo, the git defaults otherwise
+def tune_compression(repo_path, heavy):
+    for key, value in (("core.compression", str(config.BINARY_COMPRESSION)), ("core.bigFileThreshold", config.BINARY_BIG_FILE_THRESHOLD)):
+        if heavy:
+            p = subprocess.Popen(["git", "config", key, value], env=sync.env, cwd=repo_path)
+        else:
+            p = subprocess.Popen(["git", "config", "--unset", key], env=sync.env, cwd=repo_path)
+        r = p.wait()
+        #5: the key isn't set
+        if r != 0 and not (r == 5 and not heavy):
+            logger.warning("config error: %s", r)
+            return r
+    return 0
+
+#classify the files of the repo and tune its attributes and compression
+#state["binary"]: {"oid":HEAD when classified, "extensions", "share", "heavy"}
+def tune_binaries(repo_path, state):
+    head = read_ref(repo_path, "HEAD")
+    binary = state.get("binary", {})
+    if binary.get("oid") == head:
+        return
+    result = classify_repo(repo_path)
+    if result is None:
+        return
+    extensions, share = result
+    write_info_attributes(repo_path, extensions)
+    heavy = share >= config.BINARY_REPO_SHARE
+    if heavy != binary.get("heavy", False) and tune_compression(repo_path, heavy) != 0:
+        return
+    if extensions != binary.get("extensions") or heavy != binary.get("heavy", False):
+        logger.info("binary types: %s %s share: %.2f", repo_path, extensions, share)
+    update_state(state, binary={"oid":head, "extensions":extensions, "share":share, "heavy":heavy})
+
+#the git maintenance tasks due by the object counts
+#commit-graph: with the other tasks, or once a day if HEAD moved since it was written
+def maintenance_tasks(counts, head, report):
+    tasks = []
+    if counts.get("count", 0) >= config.MAINTENANCE_LOOSE_OBJECTS:
+        tasks.append("loose-objects")
+    if counts.get("packs", 0) >= config.MAINTENANCE_PACKS:
+        #writes the multi-pack-index and repacks the small packs into one,
+        #the packs it replaces are deleted by the next run
+        tasks.append("incremental-repack")
+    if head != report.get("graph_oid") and (tasks or time.time() - report.get("graph_at", 0) >= config.MAINTENANCE_GRAPH_INTERVAL):
+        tasks.append("commit-graph")
+    return tasks
+
+
+#background jobs on the repos, a repo is never maintained while it's syncing
+class Maintenance(object):
+    def __init__(self, syncer, workspace):
+        self.sync = syncer
+        self.workspace = workspace
+        self.version = sync.git_version()
+        #maintenance runs at the lowest cpu and io priority
+        self.low_priority = []
+        if os.name == "posix" and shutil.which("nice"):
+            self.low_priority += ["nice", "-n", "19"]
+        if os.name == "posix" and shutil.which("ionice"):
+            self.low_priority += ["ionice", "-c", "3"]
+
+    def maintain_repo(self, repo):
+        state = self.sync.get_state(repo["name"])
+        repo_path = os.path.join(self.workspace, repo["name"])
+        if "branch" not in state or not os.path.exists(repo_path):
+            return
+        if repo.get("shallow"):
+            self.prune_repo(repo, repo_path, state)
+        self.optimize_repo(repo["name"], repo_path, state)
+
+    def prune_repo(self, repo, repo_path, state):
+        if time.time() - state.get("pruned_at", 0) < config.SHALLOW_PRUNE_INTERVAL:
+            return
+        logger.info("prune shallow repo: %s", repo["name"])
+        depth = repo.get("depth", config.SHALLOW_DEPTH)
+        if prune_shallow(repo_path, state["branch"], depth) == 0:
+            update_state(state, pruned_at=int(time.time()))
+
+    def run_tasks(self, repo_path, tasks):
+        if self.version >= (2, 30):
+            argv = ["git", "maintenance", "run", "--quiet"] + ["--task=%s" % task for task in tasks]
+        else:
+            argv = ["git", "gc", "--auto", "--quiet"]
+        #pack-objects prints the new pack names
+        p = subprocess.Popen(self.low_priority + argv, stdout=subprocess.DEVNULL, env=sync.env, cwd=repo_path)
+        r = p.wait()
+        if r != 0:
+            logger.warning("maintenance error: %s %s", tasks, r)
+        return r
+
+    #state["maintenance"]: the last check, and the tasks of the last run
+    #with the loose objects, packs and git status seconds before and after
+    def optimize_repo(self, name, repo_path, state):
+        if not state.get("tuned") and tune_repo(repo_path, self.version, self.sync.attributesFile) == 0:
+            update_state(state, tuned=True)
+        #changed on a copy, save_states may be writing the state
+        report = dict(state.get("maintenance", {}))
+        now = time.time()
+        if now - report.get("checked_at", 0) < config.MAINTENANCE_REPO_INTERVAL:
+            return
+        report["checked_at"] = int(now)
+        update_state(state, maintenance=dict(report))
+        tune_binaries(repo_path, state)
+        counts = count_objects(repo_path)
+        if counts is None:
+            return
+        head = read_ref(repo_path, "HEAD")
+        tasks = maintenance_tasks(counts, head, report)
+        if not tasks:
+            return
+
+        before = {"loose":counts.get("count", 0), "packs":counts.get("packs", 0), "status":time_status(repo_path)}
+        begin = time.monotonic()
+        with metrics.phase(name, "maintenance") as phase:
+            r = self.run_tasks(repo_path, tasks)
+            phase.ok = r == 0
+        seconds = time.monotonic() - begin
+        counts = count_objects(repo_path) or {}
+        after = {"loose":counts.get("count", 0), "packs":counts.get("packs", 0), "status":time_status(repo_path)}
+        report.update({"time":int(now), "tasks":tasks, "result":r, "seconds":seconds, "before":before, "after":after})
+        if r == 0 and "commit-graph" in tasks:
+            report["graph_oid"] = head
+            report["graph_at"] = int(now)
+        update_state(state, maintenance=report)
+        logger.info("maintenance: %s %s %.1fs loose %d=>%d packs %d=>%d status %.3fs=>%.3fs", name, tasks, seconds,
+                    before["loose"], after["loose"], before["packs"], after["packs"], before["status"], after["status"])
+
+    def run(self):
+        while True:
+            time.sleep(config.MAINTENANCE_CHECK_INTERVAL)
+            for repo in list(self.sync.repos):
+                if repo["disabled"]:
+                    continue
+                #between the sync passes
+                if self.sync.inflight:
+                    break
+                if not self.sync.acquire_repo(repo["name"]):
+                    continue
+                try:
+                    with subprocess.context(repo["name"], "maintenance"):
+                        self.maintain_repo(repo)
+                finally:
+                    self.sync.release_repo(repo["name"])
+
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True, args=())
+        thread.start()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+import time
+import bisect
+import threading
+import collections
+from contextlib import contextmanager
+import config
+
+#upper bounds in seconds of the prometheus histogram buckets
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+#the last samples for percentiles, and cumulative buckets for prometheus
+class Histogram(object):
+    def __init__(self, window=config.METRICS_WINDOW):
+        self.samples = collections.deque(maxlen=window)
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+
+    def observe(self, seconds, ok=True):
+        self.samples.append(seconds)
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if not ok:
+            self.errors += 1
+
+    def summary(self):
+        samples = sorted(self.samples)
+        n = len(samples)
+        return {
+            "count":self.count,
+            "errors":self.errors,
+            "mean":sum(samples)/n if n else 0,
+            "p50":samples[int(n*0.5)] if n else 0,
+            "p90":samples[min(n - 1, int(n*0.9))] if n else 0,
+            "max":samples[-1] if n else 0,
+        }
+
+
+class Phase(object):
+    def __init__(self):
+        self.ok = True
+
+
+#per repo phase timings and counters
+#phases: clone, sync, fetch, commit, merge, resolve, push
+#counters: bytes_received, bytes_sent, conflicts
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        #(repo, phase) => Histogram
+        self.histograms = {}
+        #(repo, counter) => value
+        self.counters = {}
+
+    def observe(self, repo, phase, seconds, ok=True):
+        with self.lock:
+            h = self.histograms.get((repo, phase))
+            if h is None:
+                h = Histogram()
+                self.histograms[(repo, phase)] = h
+            h.observe(seconds, ok)
+
+    def add(self, repo, counter, value):
+        with self.lock:
+            self.counters[(repo, counter)] = self.counters.get((repo, counter), 0) + value
+
+    #with metrics.phase(name, "fetch") as p:
+    #    p.ok = git_fetch(repo_path) == 0
+    @contextmanager
+    def phase(self, repo, phase):
+        p = Phase()
+        begin = time.monotonic()
+        try:
+            yield p
+        except BaseException:
+            p.ok = False
+            raise
+        finally:
+            self.observe(repo, phase, time.monotonic() - begin, p.ok)
+
+    #{repo:{"phases":{phase:summary}, counter:value}}
+    def stats(self):
+        stats = {}
+        with self.lock:
+            for (repo, phase), h in self.histograms.items():
+                stats.setdefault(repo, {}).setdefault("phases", {})[phase] = h.summary()
+            for (repo, counter), value in self.counters.items():
+                stats.setdefault(repo, {})[counter] = value
+        return stats
+
+    #summed over the repos, {"phases":{phase:{count, errors, seconds}}, counter:value}
+    def totals(self):
+        totals = {"phases":{}}
+        with self.lock:
+            for (repo, phase), h in self.histograms.items():
+                t = totals["phases"].setdefault(phase, {"count":0, "errors":0, "seconds":0.0})
+                t["count"] += h.count
+                t["errors"] += h.errors
+                t["seconds"] += h.sum
+            for (repo, counter), value in self.counters.items():
+                totals[counter] = totals.get(counter, 0) + value
+        return totals
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+
+    def prometheus(self):
+        def labels(**kw):
+            return ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in kw.items())
+
+        lines = [
+            "# HELP gitcloud_phase_seconds Duration of the sync phases.",
+            "# TYPE gitcloud_phase_seconds histogram",
+        ]
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+            for (repo, phase), h in histograms:
+                total = 0
+                for le, n in zip(BUCKETS + ("+Inf",), h.buckets):
+                    total += n
+                    lines.append("gitcloud_phase_seconds_bucket{%s} %d" % (labels(repo=repo, phase=phase, le=le), total))
+                lines.append("gitcloud_phase_seconds_sum{%s} %f" % (labels(repo=repo, phase=phase), h.sum))
+                lines.append("gitcloud_phase_seconds_count{%s} %d" % (labels(repo=repo, phase=phase), h.count))
+            lines.append("# HELP gitcloud_phase_errors_total Failed runs of the sync phases.")
+            lines.append("# TYPE gitcloud_phase_errors_total counter")
+            for (repo, phase), h in histograms:
+                lines.append("gitcloud_phase_errors_total{%s} %d" % (labels(repo=repo, phase=phase), h.errors))
+
+        names = sorted(set(counter for (_, counter), _ in counters))
+        for name in names:
+            lines.append("# TYPE gitcloud_%s_total counter" % name)
+            for (repo, counter), value in counters:
+                if counter == name:
+                    lines.append("gitcloud_%s_total{%s} %d" % (name, labels(repo=repo), value))
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+
+#prometheus text format on http://127.0.0.1:<port>/metrics
+#http.server is slow to import, it's only loaded when the endpoint is enabled
+class MetricsServer(object):
+    def __init__(self, port=config.METRICS_PORT, host="127.0.0.1"):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = metrics.prometheus().encode("utf8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True, args=())
+        thread.start()
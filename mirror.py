@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+import time
+import random
+import threading
+import logging
+from subprocess import TimeoutExpired
+from concurrent.futures import ThreadPoolExecutor
+import config
+import sync
+from sync import subprocess, sync_phase, parse_progress
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+#push the synced commit to a mirror url, return (0, bytes sent) or (returncode, error line)
+#the mirror is a replica of the primary, its branch is overwritten
+def git_push_mirror(repo_path, url, branch, oid, timeout=config.MIRROR_PUSH_TIMEOUT):
+    argv = ["git", "push", "--progress", "--force", url, "%s:refs/heads/%s" % (oid, branch)]
+    p = subprocess.Popen(argv, stderr=subprocess.PIPE, env=sync.ssh_env(repo_path), cwd=repo_path, text=True)
+    try:
+        _, err = p.communicate(timeout=timeout)
+    except TimeoutExpired:
+        p.kill()
+        p.communicate()
+        return -1, "timeout after %ss" % timeout
+    lines = [line.strip() for line in err.replace("\r", "\n").split("\n") if line.strip()]
+    if p.returncode != 0:
+        errors = [line for line in lines if line.startswith(("fatal:", "error:", "!"))]
+        return p.returncode, (errors or lines or [""])[0]
+    return 0, parse_progress(err)
+
+
+#the mirrors of the repos are pushed after each successful sync, on their own pool,
+#the sync never waits for them, a push in flight is followed by one more if a newer commit came meanwhile
+#a failing mirror backs off exponentially, it's retried by the first sync after the backoff
+class Mirrors(object):
+    def __init__(self, workers=config.MIRROR_WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="mirror")
+        self.lock = threading.Lock()
+        #(name, url) => {"target":(repo_path, branch, oid), "oid":last pushed, "pushed_at", "behind_since",
+        #                "failures", "retry_at", "error", "pushing"}
+        self.states = {}
+
+    #called by the sync worker, returns at once
+    def push(self, name, repo_path, branch, oid, urls):
+        now = time.time()
+        jobs = []
+        with self.lock:
+            for key in [key for key in self.states if key[0] == name and key[1] not in urls]:
+                self.states.pop(key)
+            for url in urls:
+                state = self.states.setdefault((name, url), {"oid":None, "pushed_at":None, "behind_since":None,
+                                                             "failures":0, "retry_at":0, "error":None, "pushing":False})
+                if state["oid"] == oid:
+                    continue
+                state["target"] = (repo_path, branch, oid)
+                if state["behind_since"] is None:
+                    state["behind_since"] = now
+                if state["pushing"] or state["retry_at"] > now:
+                    continue
+                state["pushing"] = True
+                jobs.append((name, url))
+        for key in jobs:
+            self.pool.submit(self.run, key)
+
+    def run(self, key):
+        name, url = key
+        while True:
+            with self.lock:
+                state = self.states.get(key)
+                if not state or state["oid"] == state["target"][2]:
+                    if state:
+                        state["pushing"] = False
+                    return
+                repo_path, branch, oid = state["target"]
+            r, info = self.push_one(name, repo_path, url, branch, oid)
+            with self.lock:
+                state = self.states.get(key)
+                if not state:
+                    #the mirror was removed
+                    return
+                if r == 0:
+                    state["oid"] = oid
+                    state["pushed_at"] = time.time()
+                    state["failures"] = 0
+                    state["retry_at"] = 0
+                    state["error"] = None
+                    if state["target"][2] == oid:
+                        state["behind_since"] = None
+                    continue
+                state["failures"] += 1
+                delay = min(config.MIRROR_MAX_BACKOFF, config.MIRROR_RETRY * 2**(state["failures"] - 1))
+                state["retry_at"] = time.time() + delay/2 + random.uniform(0, delay/2)
+                state["error"] = info
+                state["pushing"] = False
+                return
+
+    def push_one(self, name, repo_path, url, branch, oid):
+        logger.info("push mirror: %s %s %s", name, url, oid)
+        with sync_phase(name, "mirror") as phase:
+            try:
+                r, info = git_push_mirror(repo_path, url, branch, oid)
+            except OSError as e:
+                r, info = -1, str(e)
+            phase.ok = r == 0
+        if r != 0:
+            logger.warning("push mirror error: %s %s %s %s", name, url, r, info)
+            metrics.add(name, "mirror_errors", 1)
+            return r, info
+        metrics.add(name, "mirror_bytes_sent", info)
+        return 0, None
+
+    #url => health, lag and backoff of the repo's mirrors
+    def status(self, name):
+        now = time.time()
+        with self.lock:
+            states = [(key[1], dict(state)) for key, state in self.states.items() if key[0] == name]
+        result = {}
+        for url, state in states:
+            result[url] = {
+                "healthy":state["failures"] == 0,
+                "pushing":state["pushing"],
+                "oid":state["oid"],
+                "pushed_at":state["pushed_at"],
+                #seconds since the mirror fell behind the primary
+                "lag":now - state["behind_since"] if state["behind_since"] is not None else 0,
+                "failures":state["failures"],
+                "retry_at":state["retry_at"] or None,
+                "error":state["error"],
+            }
+        return result
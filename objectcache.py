@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+import os
+import json
+import shutil
+import threading
+import logging
+import sync
+from sync import subprocess
+from storage import read_json, write_atomic
+
+logger = logging.getLogger(__name__)
+
+
+def git(args, cwd):
+    p = subprocess.Popen(["git"] + args, env=sync.ssh_env(cwd), cwd=cwd)
+    return p.wait()
+
+#copy the borrowed objects into the repo and stop borrowing, like git clone --dissociate
+def dissociate(repo_path):
+    alternates = os.path.join(repo_path, ".git", "objects", "info", "alternates")
+    if not os.path.exists(alternates):
+        return 0
+    r = git(["repack", "-a", "-d", "-q"], repo_path)
+    if r != 0:
+        logger.warning("dissociate error: %s %s", repo_path, r)
+        return r
+    os.remove(alternates)
+    return 0
+
+
+#a bare repo whose objects are borrowed by the new clones through objects/info/alternates,
+#so the objects of related repos (forks, mirrors) are downloaded and stored once
+#a borrower's refs are kept under refs/borrowers/<name>/, the objects they reach are never pruned,
+#the borrowers are counted in borrowers.json, the cache is removed with the last one
+class ObjectCache(object):
+    def __init__(self, path):
+        self.path = path
+        self.registry_path = os.path.join(path, "borrowers.json")
+        #serialize the fetches into the cache and the gc
+        self.lock = threading.Lock()
+
+    #name => repo path
+    def borrowers(self):
+        return read_json(self.registry_path, {})
+
+    def save(self, borrowers):
+        write_atomic(self.registry_path, json.dumps(borrowers).encode("utf8"))
+
+    #fetch the remote into the cache before the repo is cloned, return the reference repo, None if error
+    #run(argv, cwd) runs the fetch, the clone job passes its progress reader
+    def borrow(self, name, url, repo_path, run=None):
+        run = run or (lambda argv, cwd: git(argv[1:], cwd))
+        with self.lock:
+            if not os.path.exists(self.path):
+                r = git(["init", "-q", "--bare", self.path], None)
+                if r != 0:
+                    logger.warning("object cache init error: %s", r)
+                    return None
+            borrowers = self.borrowers()
+            borrowers[name] = repo_path
+            self.save(borrowers)
+            r = run(["git", "fetch", "--progress", "--no-tags", url, "+refs/heads/*:refs/borrowers/%s/heads/*" % name], self.path)
+        if r != 0:
+            logger.warning("object cache fetch error: %s %s", name, r)
+            return None
+        return self.path
+
+    def drop_refs(self, name):
+        p = subprocess.Popen(["git", "for-each-ref", "--format=delete %(refname)", "refs/borrowers/%s/" % name], stdout=subprocess.PIPE, env=sync.env, cwd=self.path, text=True)
+        out, _ = p.communicate()
+        if p.returncode != 0 or not out:
+            return p.returncode
+        p = subprocess.Popen(["git", "update-ref", "--stdin"], stdin=subprocess.PIPE, env=sync.env, cwd=self.path, text=True)
+        p.communicate(out)
+        return p.returncode
+
+    #a deleted repo stops borrowing, the repo directory is kept with its own copy of the objects
+    def release(self, name):
+        with self.lock:
+            borrowers = self.borrowers()
+            if name not in borrowers:
+                return
+            repo_path = borrowers.pop(name)
+            if os.path.exists(repo_path) and dissociate(repo_path) != 0:
+                #still borrowing, keep its objects
+                return
+            if self.drop_refs(name) != 0:
+                logger.warning("object cache drop refs error: %s", name)
+                return
+            self.save(borrowers)
+            if not borrowers:
+                logger.info("remove object cache: %s", self.path)
+                shutil.rmtree(self.path, ignore_errors=True)
+                return
+            self.gc(borrowers)
+
+    #pin the refs of the remaining borrowers, their objects may come from the released repo's fetch,
+    #then gc prunes the rest after the default expiry, which covers their reflogs and index
+    def gc(self, borrowers):
+        for name, repo_path in borrowers.items():
+            if not os.path.exists(os.path.join(repo_path, ".git", "objects", "info", "alternates")):
+                continue
+            r = git(["fetch", "-q", "--no-tags", repo_path, "+refs/*:refs/borrowers/%s/*" % name], self.path)
+            if r != 0:
+                logger.warning("object cache pin error, skip gc: %s %s", name, r)
+                return
+        r = git(["gc", "--quiet"], self.path)
+        if r != 0:
+            logger.warning("object cache gc error: %s", r)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+import time
+import heapq
+import random
+import threading
+import config
+
+
+#per repo next due time, a repo's interval is a factor of the base sync interval:
+#halved when the repo changed in its last sync, grown when it was idle,
+#failures back off exponentially with jitter
+class Scheduler(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        #(due, seq, name), stale entries are skipped on pop
+        self.heap = []
+        self.seq = 0
+        #name => due time
+        self.due = {}
+        #name => interval factor
+        self.factors = {}
+        #name => consecutive failures
+        self.failures = {}
+
+    def schedule(self, name, due):
+        with self.lock:
+            self.due[name] = due
+            self.seq += 1
+            heapq.heappush(self.heap, (due, self.seq, name))
+        return due
+
+    #manual and notified syncs jump the queue
+    def urgent(self, name):
+        return self.schedule(name, 0)
+
+    def remove(self, name):
+        with self.lock:
+            self.due.pop(name, None)
+            self.factors.pop(name, None)
+            self.failures.pop(name, None)
+
+    def clamp(self, limit):
+        with self.lock:
+            names = [name for name, due in self.due.items() if due > limit]
+        for name in names:
+            self.schedule(name, limit)
+
+    def next_due(self):
+        with self.lock:
+            while self.heap:
+                due, _, name = self.heap[0]
+                if self.due.get(name) == due:
+                    return due
+                heapq.heappop(self.heap)
+            return None
+
+    #names due at now, earliest first, unscheduled until reported back
+    def pop_due(self, now):
+        names = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                due, _, name = heapq.heappop(self.heap)
+                if self.due.get(name) != due:
+                    continue
+                self.due.pop(name)
+                names.append(name)
+        return names
+
+    #result None: the sync didn't run, keep the interval
+    def record(self, name, base, result, active):
+        with self.lock:
+            if result is not None and not result:
+                failures = self.failures.get(name, 0) + 1
+                self.failures[name] = failures
+                delay = min(config.SCHEDULE_MAX_BACKOFF, base * 2**failures)
+                delay = delay/2 + random.uniform(0, delay/2)
+            else:
+                if result:
+                    self.failures.pop(name, None)
+                    factor = self.factors.get(name, 1)
+                    if active:
+                        factor = max(config.SCHEDULE_MIN_FACTOR, factor/2)
+                    else:
+                        factor = min(config.SCHEDULE_MAX_FACTOR, factor*config.SCHEDULE_IDLE_GROWTH)
+                    self.factors[name] = factor
+                delay = max(config.SCHEDULE_MIN_INTERVAL, base * self.factors.get(name, 1))
+        return self.schedule(name, time.time() + delay)
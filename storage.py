@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+import os
+import copy
+import time
+import json
+import threading
+import logging
+import config
+
+logger = logging.getLogger(__name__)
+
+
+def read_json(path, default):
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+            if not data:
+                return default
+            obj = json.loads(data.decode("utf8"))
+            return obj
+    except FileNotFoundError as e:
+        return default
+
+#the file is either the old or the new content after a crash
+def write_atomic(path, data):
+    tmp = "%s.tmp%d" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError as e:
+        return
+    try:
+        os.fsync(fd)
+    except OSError as e:
+        pass
+    finally:
+        os.close(fd)
+
+
+#a json file written in the background
+#save() replaces the whole content, update() changes the fields of one named item of a list
+#updates are appended to a journal, replayed on load and compacted into the file
+class Store(object):
+    def __init__(self, path, delay=config.STORE_FLUSH_DELAY, compact=config.STORE_COMPACT_RECORDS):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.delay = delay
+        self.compact = compact
+        self.lock = threading.Condition()
+        #serialize the file writes, flush is called by the flush thread and at exit
+        self.io_lock = threading.Lock()
+        self.data = None
+        #the whole file is rewritten on the next flush
+        self.dirty = False
+        #(name, fields) waiting to be appended to the journal
+        self.records = []
+        #records in the journal file
+        self.journal_records = 0
+
+    def load(self, default):
+        data = read_json(self.path, default)
+        records = 0
+        try:
+            with open(self.journal_path, "rb") as f:
+                for line in f:
+                    try:
+                        name, fields = json.loads(line.decode("utf8"))
+                    except ValueError as e:
+                        #torn write of the last record
+                        continue
+                    self.apply(data, name, fields)
+                    records += 1
+        except FileNotFoundError as e:
+            pass
+        with self.lock:
+            self.data = data
+            if records:
+                self.dirty = True
+                self.lock.notify()
+        return copy.deepcopy(data)
+
+    @staticmethod
+    def apply(data, name, fields):
+        for item in data:
+            if item.get("name") == name:
+                item.update(fields)
+                return
+
+    def save(self, data):
+        with self.lock:
+            self.data = copy.deepcopy(data)
+            self.dirty = True
+            self.records = []
+            self.lock.notify()
+
+    def update(self, name, fields):
+        with self.lock:
+            self.apply(self.data, name, fields)
+            if not self.dirty:
+                self.records.append((name, fields))
+            self.lock.notify()
+
+    def flush(self):
+        with self.io_lock:
+            with self.lock:
+                if self.dirty or self.journal_records + len(self.records) > self.compact:
+                    data = json.dumps(self.data).encode("utf8")
+                    records = None
+                else:
+                    data = None
+                    records = self.records
+                self.dirty = False
+                self.records = []
+
+            try:
+                if data is not None:
+                    write_atomic(self.path, data)
+                    if self.journal_records or os.path.exists(self.journal_path):
+                        os.remove(self.journal_path)
+                    self.journal_records = 0
+                elif records:
+                    with open(self.journal_path, "ab") as f:
+                        for record in records:
+                            f.write((json.dumps(record) + "\n").encode("utf8"))
+                        f.flush()
+                        os.fsync(f.fileno())
+                    self.journal_records += len(records)
+            except OSError:
+                #the next flush rewrites the whole file, the journal may end with a torn record
+                with self.lock:
+                    self.dirty = True
+                    self.records = []
+                raise
+
+    def run(self):
+        while True:
+            with self.lock:
+                self.lock.wait_for(lambda: self.dirty or self.records)
+            #merge the writes of the next delay seconds
+            time.sleep(self.delay)
+            try:
+                self.flush()
+            except OSError as e:
+                logger.warning("write db error: %s %s", self.path, e)
+
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True, args=())
+        thread.start()
@@ -6,79 +6,613 @@ import subprocess as syssubprocess
 import threading, queue
 import socket
 import shutil
+import stat
 import datetime
+import re
+import copy
+import shlex
+import json
+import collections
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import config
+import storage
+from metrics import metrics
+from scheduler import Scheduler
+
+logger = logging.getLogger(__name__)
 
 env = None
 
+#"worktree": git merge in the worktree, "merge-tree": merge in memory with git merge-tree
+merge_engine = "worktree"
+
+#seconds without writes before the changes are committed, 0 commits on every sync
+commit_quiet = 0
+#commit a worktree written continuously at least this often
+commit_max_delay = config.COMMIT_MAX_DELAY
+#squash the unpushed auto commits into one before push
+squash_push = False
+#hash the large changed files in parallel before git add
+parallel_hash = False
+
+AUTO_COMMIT_MESSAGE = "git cloud auto commit"
+#the messages of the commits made by git cloud
+AUTO_MESSAGES = (AUTO_COMMIT_MESSAGE, "auto merge", "auto merge, use theirs if conflict")
+
 WAKEUP = dict({})
 
+#guards the fields of the repo states, they are changed by the sync workers and the maintenance thread
+#and copied by save_states, a reader of a single field doesn't need it
+state_lock = threading.RLock()
+
+#set the fields of a repo state
+def update_state(state, **fields):
+    with state_lock:
+        state.update(fields)
+
+#remove the fields of a repo state
+def pop_state(state, *keys):
+    with state_lock:
+        for key in keys:
+            state.pop(key, None)
+
+def record_skip(state, phase):
+    with state_lock:
+        skipped = state.setdefault("skipped", {})
+        skipped[phase] = skipped.get(phase, 0) + 1
+
+#the return code of the last run of the phase
+def record_outcome(state, phase, r):
+    with state_lock:
+        state.setdefault("outcome", {})[phase] = r
+
+#sync only the named repo, queued by the watcher and the webhook
+def sync_request(name, source):
+    return {"request":"sync", "name":name, "source":source}
+
+#a git process traced by LogSubProcess, reaped with wait4 for its cpu time
+#the child is reaped with os.wait4 by poll and wait, for its cpu time and the time it exited,
+#without wait4 (windows) the cpu time is unknown
+class TracedPopen(syssubprocess.Popen):
+    def __init__(self, tracer, args, **kwargs):
+        self.tracer = tracer
+        self.trace = tracer.begin(args, kwargs)
+        self.rusage = None
+        self.exit_time = None
+        self.communicating = False
+        #one thread reaps, a poll while another thread waits returns None like Popen.poll
+        self.reap_lock = threading.Lock()
+        super().__init__(args, **kwargs)
+
+    #return True if the child has exited
+    def reap(self, block):
+        if not self.reap_lock.acquire(block):
+            return False
+        try:
+            if self.returncode is not None:
+                return True
+            try:
+                pid, sts, rusage = os.wait4(self.pid, 0 if block else os.WNOHANG)
+            except ChildProcessError:
+                #reaped by someone else, the status is lost
+                pid, sts, rusage = self.pid, 0, None
+            if not pid:
+                return False
+            self.rusage = rusage
+            self.exit_time = time.monotonic()
+            self.returncode = os.waitstatus_to_exitcode(sts)
+            return True
+        finally:
+            self.reap_lock.release()
+
+    def poll(self):
+        if self.returncode is None and hasattr(os, "wait4"):
+            self.reap(False)
+        return super().poll()
+
+    def wait(self, timeout=None):
+        if self.returncode is None and hasattr(os, "wait4"):
+            if timeout is None:
+                self.reap(True)
+            else:
+                #like Popen.wait with a timeout, poll with a growing delay
+                deadline = time.monotonic() + timeout
+                delay = 0.0005
+                while not self.reap(False):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise syssubprocess.TimeoutExpired(self.args, timeout)
+                    time.sleep(min(delay, remaining))
+                    delay = min(delay * 2, 0.05)
+        r = super().wait(timeout)
+        if not self.communicating:
+            self.tracer.end(self)
+        return r
+
+    def communicate(self, input=None, timeout=None):
+        self.communicating = True
+        try:
+            out, err = super().communicate(input, timeout)
+        finally:
+            self.communicating = False
+        self.trace["stdout_bytes"] = len(out) if out is not None else None
+        self.trace["stderr_bytes"] = len(err) if err is not None else None
+        self.tracer.end(self)
+        return out, err
+
+
+#every git invocation is recorded with the repo and phase of the calling thread:
+#argv, wall and cpu time, exit code and output sizes
+#the traces are kept in a ring buffer, optionally appended to a json lines file
+#and passed to the hooks
 class LogSubProcess(object):
-    def Popen(self, *argv, **kwargs):
-        print("subprocess popen args:", argv, kwargs)
-        return syssubprocess.Popen(*argv, **kwargs)
+    PIPE = syssubprocess.PIPE
+    DEVNULL = syssubprocess.DEVNULL
+
+    def __init__(self, size=config.TRACE_BUFFER):
+        self.traces = collections.deque(maxlen=size)
+        #(repo, phase) of the calling thread or asyncio task
+        self.context_var = contextvars.ContextVar("git_context", default=(None, None))
+        self.lock = threading.Lock()
+        self.trace_file = None
+        self.hooks = []
+
+    #with subprocess.context(name, "fetch"): the git processes started by this thread belong to the phase
+    @contextmanager
+    def context(self, repo=None, phase=None):
+        saved = self.context_var.get()
+        token = self.context_var.set((repo or saved[0], phase or saved[1]))
+        try:
+            yield
+        finally:
+            self.context_var.reset(token)
+
+    def set_trace_file(self, path):
+        with self.lock:
+            if self.trace_file:
+                self.trace_file.close()
+            self.trace_file = open(path, "a", encoding="utf8") if path else None
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def get_traces(self, limit=None):
+        with self.lock:
+            traces = list(self.traces)
+        return traces[-limit:] if limit else traces
+
+    def Popen(self, argv, **kwargs):
+        return TracedPopen(self, argv, **kwargs)
+
+    def begin(self, argv, kwargs):
+        repo, phase = self.context_var.get()
+        logger.debug("git: %s %s", argv, kwargs.get("cwd"))
+        return {"time":time.time(), "start":time.monotonic(), "repo":repo, "phase":phase, "argv":list(argv), "cwd":kwargs.get("cwd")}
+
+    def end(self, p):
+        if "wall" in p.trace:
+            return
+        self.record(p.trace, p.returncode, p.rusage.ru_utime + p.rusage.ru_stime if p.rusage else None, p.exit_time)
+
+    #finish a trace made by begin, also used for the processes of aiosync
+    #exit_time: time.monotonic() when the process exited, now if unknown
+    def record(self, trace, returncode, cpu=None, exit_time=None):
+        trace["wall"] = (exit_time or time.monotonic()) - trace.pop("start")
+        trace["returncode"] = returncode
+        trace["cpu"] = cpu
+        trace.setdefault("stdout_bytes", None)
+        trace.setdefault("stderr_bytes", None)
+        with self.lock:
+            self.traces.append(trace)
+            if self.trace_file:
+                self.trace_file.write(json.dumps(trace) + "\n")
+                self.trace_file.flush()
+        for hook in list(self.hooks):
+            try:
+                hook(trace)
+            except Exception as e:
+                logger.exception("trace hook error")
 subprocess = LogSubProcess()
-subprocess.PIPE = syssubprocess.PIPE
+
+#the git processes of the block are traced with the repo and phase, and the phase is timed
+@contextmanager
+def sync_phase(repo, phase):
+    with subprocess.context(repo, phase), metrics.phase(repo, phase) as p:
+        yield p
+
+#directory of the ssh control sockets, None disables the connection sharing
+ssh_control_dir = None
+#cwd => (time, core.sshCommand or None), the config is read at most every SSH_COMMAND_TTL seconds
+ssh_commands = {}
+ssh_commands_lock = threading.Lock()
+
+#the sockets must be in a directory other users can't write to,
+#ssh fails if the socket path is too long or has a double quote, then the connections aren't shared
+def set_ssh_control_dir(path):
+    global ssh_control_dir
+    if '"' in path or len(os.fsencode(path)) + 1 + 40 + 17 > config.SSH_SOCKET_MAX_PATH:
+        logger.warning("ssh control dir path too long, connections not shared: %s", path)
+        ssh_control_dir = None
+        return
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        os.chmod(path, 0o700)
+    except OSError as e:
+        logger.warning("ssh control dir error, connections not shared: %s %s", path, e)
+        ssh_control_dir = None
+        return
+    ssh_control_dir = path
+
+#core.sshCommand of the repo or the global config, None if not set
+def get_ssh_command(cwd):
+    now = time.monotonic()
+    with ssh_commands_lock:
+        cached = ssh_commands.get(cwd)
+    if cached and now - cached[0] < config.SSH_COMMAND_TTL:
+        return cached[1]
+    p = subprocess.Popen(["git", "config", "--get", "core.sshCommand"], stdout=subprocess.PIPE, env=env, cwd=cwd, text=True)
+    out, _ = p.communicate()
+    command = out.strip() if p.returncode == 0 and out.strip() else None
+    with ssh_commands_lock:
+        ssh_commands[cwd] = (now, command)
+    return command
+
+#share one ssh connection per host between ls-remote/fetch/push,
+#unless the ssh command is picked by GIT_SSH_COMMAND, GIT_SSH or core.sshCommand, e.g. for a deploy key
+def ssh_env(cwd=None):
+    e = (env or os.environ).copy()
+    if os.name == "nt" or not ssh_control_dir or "GIT_SSH_COMMAND" in e or "GIT_SSH" in e:
+        return e
+    if cwd is not None and not os.path.isdir(cwd):
+        cwd = None
+    if get_ssh_command(cwd):
+        return e
+    #git runs the command with the shell, and ssh splits an option value at the spaces unless it's in double quotes
+    control_path = 'ControlPath="%s"' % os.path.join(ssh_control_dir, "%C")
+    e["GIT_SSH_COMMAND"] = "ssh -o ControlMaster=auto -o %s -o ControlPersist=60" % shlex.quote(control_path)
+    return e
+
+#read a ref without spawning git, return None if the ref doesn't exist
+def read_ref(repo_path, ref):
+    git_dir = os.path.join(repo_path, ".git")
+    try:
+        with open(os.path.join(git_dir, ref), "r") as f:
+            value = f.read().strip()
+            if value.startswith("ref: "):
+                return read_ref(repo_path, value[5:])
+            return value or None
+    except OSError as e:
+        pass
+
+    try:
+        with open(os.path.join(git_dir, "packed-refs"), "r") as f:
+            for line in f:
+                if line.startswith("#") or line.startswith("^"):
+                    continue
+                a = line.split()
+                if len(a) == 2 and a[1] == ref:
+                    return a[0]
+    except OSError as e:
+        pass
+    return None
+
+#return {ref:oid} of the remote branches, None if error
+def git_ls_remote(repo_path, remote="origin"):
+    cwd = repo_path
+    p = subprocess.Popen(["git", "ls-remote", "--heads", remote], stdout=subprocess.PIPE, env=ssh_env(cwd), cwd=cwd, text=True)
+    out, _ = p.communicate()
+    if p.returncode != 0:
+        logger.warning("ls-remote error: %s", p.returncode)
+        return None
+    heads = {}
+    for line in out.split("\n"):
+        if not line:
+            continue
+        oid, ref = line.split("\t")
+        heads[ref] = oid
+    return heads
+
+#"Receiving objects: 100% (202/202), 7.30 KiB | 7.30 MiB/s, done."
+TRANSFER_RE = re.compile(r"(?:Receiving|Writing) objects: 100% \(\d+/\d+\), ([\d.]+) (bytes|KiB|MiB|GiB)")
+TRANSFER_UNITS = {"bytes":1, "KiB":1024, "MiB":1024**2, "GiB":1024**3}
+
+#print the final state of the progress lines, return the bytes git reported
+#git reports no size for the small fetches unpacked to loose objects
+def parse_progress(err):
+    size = 0
+    for line in err.split("\n"):
+        line = line.split("\r")[-1].rstrip()
+        if not line:
+            continue
+        logger.info("%s", line)
+        m = TRANSFER_RE.search(line)
+        if m:
+            size += int(float(m.group(1)) * TRANSFER_UNITS[m.group(2)])
+    return size
+
+#run fetch/push with --progress, return (returncode, bytes transferred)
+def git_transfer(argv, cwd):
+    p = subprocess.Popen(argv[:2] + ["--progress"] + argv[2:], stderr=subprocess.PIPE, env=ssh_env(cwd), cwd=cwd)
+    _, err = p.communicate()
+    return p.returncode, parse_progress(err.decode("utf8", "replace"))
+
+#1 <XY> <sub> <mH> <mI> <mW> <hH> <hI> <path>
+#2 <XY> <sub> <mH> <mI> <mW> <hH> <hI> <X><score> <path> NUL <origPath>
+#u <XY> <sub> <m1> <m2> <m3> <mW> <h1> <h2> <h3> <path>
+#? <path>
+def parse_porcelain_v2(out):
+    paths = []
+    records = out.split("\0")
+    i = 0
+    while i < len(records):
+        record = records[i]
+        i += 1
+        if record.startswith("1 "):
+            paths.append(record.split(" ", 8)[8])
+        elif record.startswith("2 "):
+            paths.append(record.split(" ", 9)[9])
+            if i < len(records):
+                paths.append(records[i])
+                i += 1
+        elif record.startswith("u "):
+            paths.append(record.split(" ", 10)[10])
+        elif record.startswith("? "):
+            paths.append(record[2:])
+    return paths
+
+#write the blobs of the large files with parallel git hash-object processes,
+#git add then finds the objects and only computes their ids instead of compressing them again
+def hash_large_files(repo_path, paths):
+    large = []
+    for path in paths:
+        try:
+            st = os.lstat(os.path.join(repo_path, path))
+        except OSError as e:
+            continue
+        if stat.S_ISREG(st.st_mode) and st.st_size >= config.PARALLEL_HASH_MIN_SIZE:
+            large.append(path)
+    if len(large) < 2:
+        return
+
+    def hash_object(path):
+        p = subprocess.Popen(["git", "hash-object", "-w", "--", path], stdout=subprocess.DEVNULL, env=env, cwd=repo_path)
+        return p.wait()
+    logger.info("hash %d large files", len(large))
+    with ThreadPoolExecutor(max_workers=config.PARALLEL_HASH_WORKERS) as pool:
+        for path, r in zip(large, pool.map(hash_object, large)):
+            if r != 0:
+                logger.warning("hash object error: %s %s", path, r)
+
+#the git operations of the sync pipeline, one git process per operation
+#gitengine.Pygit2Engine implements the same methods in process
+class SubprocessEngine(object):
+    name = "subprocess"
+
+    def fetch(self, repo_path):
+        r, size = git_transfer(["git", "fetch"], repo_path)
+        metrics.add(os.path.basename(repo_path), "bytes_received", size)
+        return r
+
+    #return (returncode, changed paths), both paths of a rename, every untracked file
+    def status(self, repo_path):
+        p = subprocess.Popen(["git", "status", "--porcelain=v2", "-z", "--untracked-files=all"], stdout=subprocess.PIPE, env=env, cwd=repo_path, text=True)
+        out, _ = p.communicate()
+        if p.returncode != 0:
+            return p.returncode, []
+        return 0, parse_porcelain_v2(out)
+
+    #stage the changed, added and deleted paths listed by status
+    def add_paths(self, repo_path, paths):
+        exists = set(path for path in paths if os.path.lexists(os.path.join(repo_path, path)))
+        #deleted, maybe already removed from the index by git rm or git mv
+        missing = [path for path in paths if path not in exists]
+        exists = [path for path in paths if path in exists]
+        if parallel_hash:
+            hash_large_files(repo_path, exists)
+        sparse = sparse_args()
+        r = git_pathspec(repo_path, ["add", "--all"] + sparse, exists)
+        if r != 0:
+            return r
+        return git_pathspec(repo_path, ["rm", "--cached", "--quiet", "--ignore-unmatch"] + sparse, missing)
+
+    def commit(self, repo_path, message):
+        p = subprocess.Popen(["git", "commit", "-m", message], env=env, cwd=repo_path)
+        return p.wait()
+
+    #return 0 if merged, 1 if the conflicts are left in the index, 2 if the merge didn't start
+    def merge(self, repo_path, rev, message):
+        p = subprocess.Popen(["git", "merge", "-m", message, rev], env=env, cwd=repo_path)
+        r = p.wait()
+        #git merge also exits 1 when local changes would be overwritten,
+        #a merge stopped by conflicts leaves MERGE_HEAD
+        if r == 1 and not read_ref(repo_path, "MERGE_HEAD"):
+            logger.warning("merge didn't start: %s", r)
+            return 2
+        return r
+
+    def push(self, repo_path):
+        r, size = git_transfer(["git", "push", "origin"], repo_path)
+        metrics.add(os.path.basename(repo_path), "bytes_sent", size)
+        return r
+
+    #return the object ids, None if error
+    def rev_parse(self, repo_path, revs):
+        p = subprocess.Popen(["git", "rev-parse"] + list(revs), stdout=subprocess.PIPE, env=env, cwd=repo_path, text=True)
+        out, _ = p.communicate()
+        if p.returncode != 0:
+            return None
+        return out.split()
+
+    #return (returncode, [(mode, obj_id, stage, filename)])
+    def ls_files_unmerged(self, repo_path):
+        p = subprocess.Popen(["git", "ls-files", "-u", "-z"], stdout=subprocess.PIPE, env=env, cwd=repo_path, text=True)
+        out, _ = p.communicate()
+        if p.returncode != 0:
+            return p.returncode, []
+
+        entries = []
+        #100644 5c65e6d439f561117332e6e04c8fb25ae3b3a116 2	vvv
+        for line in out.split("\0"):
+            if not line:
+                #last line
+                continue
+            try:
+                s, filename = line.split("\t", 1)
+                mode, obj_id, stage_number = s.split(" ")
+                entries.append((mode, obj_id, stage_number, filename))
+            except Exception as e:
+                logger.warning("invalid line format: %s", line)
+                continue
+        return 0, entries
+
+    #write the blobs to files through one git cat-file --batch process
+    #blobs: [(obj_id, filename)]
+    def cat_blobs(self, repo_path, blobs):
+        if not blobs:
+            return 0
+        cwd = repo_path
+        p = subprocess.Popen(["git", "cat-file", "--batch"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env, cwd=cwd)
+        r = 0
+        try:
+            for obj_id, filename in blobs:
+                p.stdin.write(("%s\n" % obj_id).encode("utf8"))
+                p.stdin.flush()
+                #<oid> SP <type> SP <size> LF <contents> LF
+                header = p.stdout.readline().decode("utf8").split()
+                if len(header) != 3:
+                    logger.warning("cat file err: %s", header)
+                    r = 1
+                    break
+                size = int(header[2])
+                with open(filename, "wb") as f:
+                    while size > 0:
+                        data = p.stdout.read(min(size, 1024*1024))
+                        if not data:
+                            break
+                        f.write(data)
+                        size -= len(data)
+                p.stdout.read(1)
+                if size > 0:
+                    logger.warning("cat file err: truncated %s", obj_id)
+                    r = 1
+                    break
+        finally:
+            p.stdin.close()
+            p.stdout.close()
+            p.wait()
+        return r
+
+engine = SubprocessEngine()
+
 
 def git_fetch(repo_path):
-    cwd = repo_path        
-    p = subprocess.Popen(["git", "fetch"], cwd=cwd)
-    r = p.wait()
+    r = engine.fetch(repo_path)
     if r != 0:
-        print("fetch error:", r)
+        logger.warning("fetch error: %s", r)
     return r
 
 
-def git_config(repo_path, excludesFile):
+def git_config(repo_path, excludesFile, attributesFile=None):
     cwd = repo_path 
     p = subprocess.Popen(["git", "config", "core.excludesFile", excludesFile], cwd=cwd)      
     r = p.wait()
     if r != 0:
-        print("config error:", r)
+        logger.warning("config error: %s", r)
+        return r
+    if attributesFile:
+        p = subprocess.Popen(["git", "config", "core.attributesFile", attributesFile], cwd=cwd)
+        r = p.wait()
+        if r != 0:
+            logger.warning("config error: %s", r)
     return r
 
-#todo run long time, wait in thread
-def git_clone(repo_path, url, depth=None):
-    cwd = os.path.dirname(repo_path)
-    if depth is None:
-        p = subprocess.Popen(["git", "clone", url, repo_path], env=env, cwd=cwd)
-    else:
-        p = subprocess.Popen(["git", "clone", "--depth", depth, url, repo_path], env=env, cwd=cwd)
-    r = p.wait()
-    if r != 0:
-        print("clone error:", r)
-        
-    return r
-    
+#cone mode sparse checkout of the folders, None checks out everything
+def git_sparse_checkout(repo_path, folders):
+    cwd = repo_path
+    if folders is None:
+        p = subprocess.Popen(["git", "sparse-checkout", "disable"], env=env, cwd=cwd)
+        r = p.wait()
+        if r != 0:
+            logger.warning("sparse checkout disable error: %s", r)
+        return r
+
+    #turn a full clone into a partial clone, blobs outside the folders are never fetched
+    for key, value in (("remote.origin.promisor", "true"), ("remote.origin.partialclonefilter", "blob:none")):
+        p = subprocess.Popen(["git", "config", key, value], env=env, cwd=cwd)
+        r = p.wait()
+        if r != 0:
+            logger.warning("config error: %s", r)
+            return r
+
+    p = subprocess.Popen(["git", "sparse-checkout", "set", "--cone", "--stdin"], stdin=subprocess.PIPE, env=ssh_env(cwd), cwd=cwd)
+    p.communicate("".join(folder + "\n" for folder in folders).encode("utf8"))
+    if p.returncode != 0:
+        logger.warning("sparse checkout error: %s", p.returncode)
+    return p.returncode
+
 def get_branch(repo_path):
     cwd = repo_path
     p = subprocess.Popen(["git", "symbolic-ref", "--short", "-q", "HEAD"], stdout=subprocess.PIPE, env=env, cwd=cwd, text=True)
     out, _ = p.communicate()
     if p.returncode != 0:
-        print("get branch err:", p.returncode)
+        logger.warning("get branch err: %s", p.returncode)
         return None
     return out.rstrip()
 
-def git_commit(repo_path):
-    cwd = repo_path
-    p = subprocess.Popen(["git", "status", "-s"], stdout=subprocess.PIPE, env=env, cwd=cwd, text=True)
-    out, _ = p.communicate()
-    if p.returncode != 0:
-        return p.returncode
-    if len(out) == 0:
-        print("worktree is clean")
+#the newest mtime of the paths, the deleted paths have none
+def newest_mtime(repo_path, paths):
+    newest = 0
+    for path in paths:
+        try:
+            newest = max(newest, os.lstat(os.path.join(repo_path, path)).st_mtime)
+        except OSError as e:
+            pass
+    return newest
+
+#return the time the commit of the changed paths is due, None to commit now
+def commit_due_time(repo_path, paths, state):
+    if not commit_quiet:
+        return None
+    now = time.time()
+    with state_lock:
+        dirty_since = state.setdefault("dirty_since", now)
+    due = min(newest_mtime(repo_path, paths) + commit_quiet, dirty_since + commit_max_delay)
+    return due if due > now else None
+
+# state: the repo's sync state, records when a deferred commit is due
+def git_commit(repo_path, state=None):
+    if state is None:
+        state = {}
+    r, changes = engine.status(repo_path)
+    if r != 0:
+        return r
+    pop_state(state, "commit_due")
+    if not changes:
+        pop_state(state, "dirty_since")
+        logger.info("worktree is clean")
         return 0
 
-    p = subprocess.Popen(["git", "add", "."], cwd=cwd)
-    r = p.wait()
+    due = commit_due_time(repo_path, changes, state)
+    if due is not None:
+        logger.info("worktree is changing, defer commit %.1fs", due - time.time())
+        update_state(state, commit_due=due)
+        return 0
+    pop_state(state, "dirty_since")
+
+    r = engine.add_paths(repo_path, changes)
     if r != 0:
-        print("add error:", r)
+        logger.warning("add error: %s", r)
         return r
 
-    p = subprocess.Popen(["git", "commit", "-m", "git cloud auto commit"], env=env, cwd=cwd)
-    r = p.wait()
+    r = engine.commit(repo_path, AUTO_COMMIT_MESSAGE)
     if r != 0:
-        print("commit error:", r)
+        logger.warning("commit error: %s", r)
     return r
 
 def git_rebase(repo_path, branch):
@@ -86,116 +620,105 @@ def git_rebase(repo_path, branch):
     p = subprocess.Popen(["git", "rebase", "origin/%s"%branch], env=env, cwd=cwd)
     r = p.wait()
     if r != 0:
-        print("rebase error:", r)
+        logger.warning("rebase error: %s", r)
     return r
 
 
 def get_conflict_files(repo_path, conflict_files):
-    cwd = repo_path    
-    p = subprocess.Popen(["git", "ls-files", "-u"], stdout=subprocess.PIPE, env=env, cwd=cwd, text=True)
-    out, _ = p.communicate()
-    if p.returncode != 0:
-        return p.returncode
+    r, entries = engine.ls_files_unmerged(repo_path)
+    if r != 0:
+        return r
 
-    lines = out.split("\n")
     d = {}
-    #100644 5c65e6d439f561117332e6e04c8fb25ae3b3a116 2	vvv
-    for line in lines:
-        if not line:
-            #last line
-            continue
-        try:
-            s, filename = line.split("\t")
-            _, obj_id, stage_number = s.split(" ")
-            if filename in d:
-                item = d.get(filename)
-            else:
-                item = {
-                    "name":filename, 
-                    "our_exists":False, 
-                    "their_exists":False, 
-                    "ancestor_exists":False
-                }
-                conflict_files.append(item)
-                d[filename] = item
-            # stage number 1:O stage ancestor, 2:A stage current, 3:B stage other 
-            if stage_number == "2":
-                item["our_exists"] = True
-                item["our_obj_id"] = obj_id
-            elif stage_number == "3":
-                item["their_exists"] = True
-            elif stage_number == "1":
-                item["ancestor_exists"] = True
-
-        except Exception as e:
-            print("invalid line format:", line)
-            continue
+    for _, obj_id, stage_number, filename in entries:
+        if filename in d:
+            item = d.get(filename)
+        else:
+            item = {
+                "name":filename, 
+                "our_exists":False, 
+                "their_exists":False, 
+                "ancestor_exists":False
+            }
+            conflict_files.append(item)
+            d[filename] = item
+        # stage number 1:O stage ancestor, 2:A stage current, 3:B stage other 
+        if stage_number == "2":
+            item["our_exists"] = True
+            item["our_obj_id"] = obj_id
+        elif stage_number == "3":
+            item["their_exists"] = True
+        elif stage_number == "1":
+            item["ancestor_exists"] = True
     return 0
 
 
-
+#run a git command on many paths at once, the paths are passed through stdin
+def git_pathspec(repo_path, args, paths):
+    if not paths:
+        return 0
+    cwd = repo_path
+    argv = ["git", "--literal-pathspecs"] + args + ["--pathspec-from-file=-", "--pathspec-file-nul"]
+    p = subprocess.Popen(argv, stdin=subprocess.PIPE, env=env, cwd=cwd)
+    data = "".join(path + "\0" for path in paths)
+    p.communicate(data.encode("utf8"))
+    if p.returncode != 0:
+        logger.warning("%s error: %s", args[0], p.returncode)
+    return p.returncode
 
 
 #merge conflict:theirs
 def merge_conflict_theirs(repo_path, conflict_items, conflict_files):
-    cwd = repo_path
+    rm_files = []
+    theirs_files = []
+    add_files = []
+    blobs = []
     for item in conflict_items:
         filename = item["name"]
         if not item["our_exists"] and not item["their_exists"]:
-            #git rm
-            p = subprocess.Popen(["git", "rm", filename], env=env, cwd=cwd)
-            r = p.wait()
-            if r != 0:
-                return r
-        elif item["their_exists"] and not item["our_exists"]:
-            #git add
-            p = subprocess.Popen(["git", "add", filename], env=env, cwd=cwd)
-            r = p.wait()
-            if r != 0:
-                return r
-        elif item["our_exists"] and not item["their_exists"]:
-            #git add
-            p = subprocess.Popen(["git", "add", filename], env=env, cwd=cwd)
-            r = p.wait()
-            if r != 0:
-                return r
+            rm_files.append(filename)
+        elif item["our_exists"] and item["their_exists"]:
+            theirs_files.append(filename)
+            add_files.append(filename)
+            blobs.append((item["our_obj_id"], os.path.join(repo_path, filename + ".conflict")))
         else:
-            #item["our_exists"] and item["their_exists"]
-            p = subprocess.Popen(["git", "checkout", "--theirs", filename], env=env, cwd=cwd)
-            r = p.wait()
-            if r != 0:
-                return r
-            p = subprocess.Popen(["git", "add", filename], env=env, cwd=cwd)
-            r = p.wait()
-            if r != 0:
-                return r
-
-            obj_id = item["our_obj_id"]
-            cf_file = os.path.join(repo_path, filename + ".conflict")
-            with open(cf_file, "wb") as f:
-                p = subprocess.Popen(["git", "cat-file", "-p", obj_id], stdout=f, env=env, cwd=cwd)
-                r = p.wait()
-                if r != 0:
-                    print("cat file err:", r)
-                    return r
-                conflict_files.append(filename)
+            #only one side exists, keep it
+            add_files.append(filename)
+
+    r = git_pathspec(repo_path, ["rm"], rm_files)
+    if r != 0:
+        return r
+    r = git_pathspec(repo_path, ["checkout", "--theirs"], theirs_files)
+    if r != 0:
+        return r
+    r = git_pathspec(repo_path, ["add"], add_files)
+    if r != 0:
+        return r
+    r = engine.cat_blobs(repo_path, blobs)
+    if r != 0:
+        return r
+    conflict_files.extend(theirs_files)
     return 0
 
-def git_merge(repo_path, branch):
-    cwd = repo_path    
-    p = subprocess.Popen(["git", "merge", "-m", "auto merge", "origin/%s"%branch], env=env, cwd=cwd)
-    r = p.wait()
+def git_merge_worktree(repo_path, branch):
+    r = engine.merge(repo_path, "origin/%s"%branch, "auto merge")
+    if r > 1 or r < 0:
+        logger.warning("merge error: %s", r)
+        return r
     if r != 0:
-        print("merge conflict:", r)
-        conflict_items = []
-        get_conflict_files(repo_path, conflict_items)
-        #filename array
-        conflict_files = []
-        merge_conflict_theirs(repo_path, conflict_items, conflict_files)
-        p = subprocess.Popen(["git", "commit", "-m", "auto merge, use theirs if conflict"], env=env, cwd=cwd)
-        r = p.wait()
+        logger.info("merge conflict: %s", r)
+        name = os.path.basename(repo_path)
+        with sync_phase(name, "resolve") as phase:
+            conflict_items = []
+            get_conflict_files(repo_path, conflict_items)
+            metrics.add(name, "conflicts", len(conflict_items))
+            #filename array
+            conflict_files = []
+            merge_conflict_theirs(repo_path, conflict_items, conflict_files)
+            r = engine.commit(repo_path, "auto merge, use theirs if conflict")
+            phase.ok = r == 0
         if r != 0:
-            print("merge with theirs err:", r)
+            logger.warning("merge with theirs err: %s", r)
             return r
         
         for c in conflict_files:
@@ -206,52 +729,338 @@ def git_merge(repo_path, branch):
 
     return r
 
-def git_push(repo_path):
-    cwd = repo_path    
-    p = subprocess.Popen(["git", "push", "origin"], env=env, cwd=cwd)
+def git_rev_parse(repo_path, *revs):
+    return engine.rev_parse(repo_path, revs)
+
+
+#theirs wins, ours is kept as a conflicted copy
+#entries: [(mode, obj_id, stage, filename)] the conflicted entries from merge-tree
+#return the index-info lines applied to the merged tree
+def resolve_conflicts_theirs(repo_path, entries):
+    stages = {}
+    for mode, obj_id, stage, filename in entries:
+        stages.setdefault(filename, {})[stage] = (mode, obj_id)
+
+    lines = []
+    for filename, item in stages.items():
+        if "3" in item:
+            mode, obj_id = item["3"]
+            lines.append("%s %s 0\t%s" % (mode, obj_id, filename))
+            if "2" in item:
+                mode, obj_id = item["2"]
+                copy_filename = generate_conflicted_filename(os.path.join(repo_path, filename))
+                copy_filename = os.path.relpath(copy_filename, repo_path).replace(os.sep, "/")
+                lines.append("%s %s 0\t%s" % (mode, obj_id, copy_filename))
+        elif "2" in item:
+            mode, obj_id = item["2"]
+            lines.append("%s %s 0\t%s" % (mode, obj_id, filename))
+        else:
+            lines.append("0 %s 0\t%s" % ("0"*40, filename))
+    return lines
+
+
+#merge without touching the worktree, then check out the result once
+#return None if the merge can't be done in memory
+def git_merge_tree(repo_path, branch):
+    cwd = repo_path
+    theirs = "origin/%s" % branch
+    oids = git_rev_parse(repo_path, "HEAD", theirs)
+    if not oids or len(oids) != 2:
+        return None
+    head, their_oid = oids
+    p = subprocess.Popen(["git", "merge-base", head, their_oid], stdout=subprocess.PIPE, env=env, cwd=cwd, text=True)
+    out, _ = p.communicate()
+    base = out.strip()
+    if base == their_oid:
+        logger.info("Already up to date.")
+        return 0
+    if base == head:
+        p = subprocess.Popen(["git", "merge", "--ff-only", their_oid], env=env, cwd=cwd)
+        return p.wait()
+
+    p = subprocess.Popen(["git", "merge-tree", "--write-tree", "-z", head, their_oid], stdout=subprocess.PIPE, env=env, cwd=cwd, text=True)
+    out, _ = p.communicate()
+    if p.returncode not in (0, 1):
+        logger.warning("merge-tree error: %s", p.returncode)
+        return None
+
+    #<tree> NUL <mode> SP <oid> SP <stage> TAB <path> NUL ... NUL <messages>
+    fields = out.split("\0")
+    tree = fields[0]
+    entries = []
+    for field in fields[1:]:
+        if not field:
+            break
+        s, filename = field.split("\t", 1)
+        mode, obj_id, stage = s.split(" ")
+        entries.append((mode, obj_id, stage, filename))
+
+    message = "auto merge"
+    if entries:
+        name = os.path.basename(repo_path)
+        conflicts = len(set(e[3] for e in entries))
+        logger.info("merge conflict: %s", conflicts)
+        metrics.add(name, "conflicts", conflicts)
+        message = "auto merge, use theirs if conflict"
+        begin = time.monotonic()
+        lines = resolve_conflicts_theirs(repo_path, entries)
+        index_file = os.path.join(repo_path, ".git", "gitcloud-merge-index")
+        merge_env = (env or os.environ).copy()
+        merge_env["GIT_INDEX_FILE"] = index_file
+        try:
+            p = subprocess.Popen(["git", "read-tree", tree], env=merge_env, cwd=cwd)
+            if p.wait() != 0:
+                return None
+            p = subprocess.Popen(["git", "update-index", "-z", "--index-info"], stdin=subprocess.PIPE, env=merge_env, cwd=cwd)
+            p.communicate("".join(line + "\0" for line in lines).encode("utf8"))
+            if p.returncode != 0:
+                return None
+            p = subprocess.Popen(["git", "write-tree"], stdout=subprocess.PIPE, env=merge_env, cwd=cwd, text=True)
+            out, _ = p.communicate()
+            if p.returncode != 0:
+                return None
+            tree = out.strip()
+            metrics.observe(name, "resolve", time.monotonic() - begin)
+        finally:
+            if os.path.exists(index_file):
+                os.remove(index_file)
+
+    p = subprocess.Popen(["git", "commit-tree", tree, "-p", head, "-p", their_oid, "-m", message], stdout=subprocess.PIPE, env=env, cwd=cwd, text=True)
+    out, _ = p.communicate()
+    if p.returncode != 0:
+        return None
+    commit = out.strip()
+
+    #worktree and index first, if this fails HEAD is untouched
+    p = subprocess.Popen(["git", "read-tree", "-m", "-u", head, commit], env=env, cwd=cwd)
+    if p.wait() != 0:
+        logger.warning("checkout merge result error")
+        return None
+    p = subprocess.Popen(["git", "update-ref", "-m", message, "HEAD", commit, head], env=env, cwd=cwd)
     r = p.wait()
     if r != 0:
-        print("push error:", r)
+        logger.warning("update HEAD error: %s", r)
     return r
 
 
-def need_push(repo_path, branch):
+def git_merge(repo_path, branch):
+    if merge_engine == "merge-tree":
+        r = git_merge_tree(repo_path, branch)
+        if r is not None:
+            return r
+        logger.warning("merge-tree failed, merge in worktree")
+    return git_merge_worktree(repo_path, branch)
+
+
+#replace the unpushed commits with one commit of the same tree on top of the remote branch
+#only if all of them were made by git cloud, the worktree and the index are untouched
+#return 0 if squashed or nothing to squash
+def squash_auto_commits(repo_path, branch):
     cwd = repo_path
-    p = subprocess.Popen(["git", "rev-parse", "HEAD", "origin/HEAD"], stdout=subprocess.PIPE, env=env, cwd=cwd, text=True)
+    remote = "refs/remotes/origin/%s" % branch
+    p = subprocess.Popen(["git", "log", "-z", "--format=%s", "%s..HEAD" % remote], stdout=subprocess.PIPE, env=env, cwd=cwd, text=True)
     out, _ = p.communicate()
     if p.returncode != 0:
-        return True
-    a = out.split("\n")
-    if len(a) < 2:
+        return p.returncode
+    subjects = [subject for subject in out.split("\0") if subject]
+    if len(subjects) < 2 or any(subject not in AUTO_MESSAGES for subject in subjects):
+        return 0
+    p = subprocess.Popen(["git", "merge-base", "--is-ancestor", remote, "HEAD"], env=env, cwd=cwd)
+    if p.wait() != 0:
+        return 0
+
+    oids = git_rev_parse(repo_path, "HEAD", "HEAD^{tree}")
+    if not oids or len(oids) != 2:
+        return 1
+    head, tree = oids
+    p = subprocess.Popen(["git", "commit-tree", tree, "-p", remote, "-m", AUTO_COMMIT_MESSAGE], stdout=subprocess.PIPE, env=env, cwd=cwd, text=True)
+    out, _ = p.communicate()
+    if p.returncode != 0:
+        logger.warning("squash commit error: %s", p.returncode)
+        return p.returncode
+    p = subprocess.Popen(["git", "update-ref", "-m", "squash auto commits", "HEAD", out.strip(), head], env=env, cwd=cwd)
+    r = p.wait()
+    if r != 0:
+        logger.warning("squash update HEAD error: %s", r)
+    else:
+        logger.info("squash %d auto commits", len(subjects))
+    return r
+
+def git_push(repo_path):
+    r = engine.push(repo_path)
+    if r != 0:
+        logger.warning("push error: %s", r)
+    return r
+
+
+def need_push(repo_path, branch):
+    head = read_ref(repo_path, "HEAD")
+    remote = read_ref(repo_path, "refs/remotes/origin/%s" % branch)
+    if head and remote:
+        return head != remote
+
+    a = git_rev_parse(repo_path, "HEAD", "origin/HEAD")
+    if not a or len(a) < 2:
         return True
     return not a[0] == a[1]
 
 
+#stat of .git/index, changes whenever git touches the index
+def index_signature(repo_path):
+    try:
+        st = os.stat(os.path.join(repo_path, ".git", "index"))
+        return [st.st_mtime_ns, st.st_size]
+    except OSError as e:
+        return None
+
+
+#the remote tip of a probe, heads: {ref:oid} of git ls-remote, None if it failed
+def record_probe(state, heads, branch):
+    if heads is None:
+        pop_state(state, "remote_oid")
+    else:
+        update_state(state, remote_oid=heads.get("refs/heads/%s" % branch))
+
+#the skips of a sync from the recorded state, return (moved, merged, fetch)
+#moved: HEAD moved outside of git cloud, nothing recorded can be trusted
+#merged: the probed remote tip is merged already, skip fetch and merge
+#fetch: the remote tip isn't known or isn't fetched yet
+def plan_sync(repo_path, branch, state):
+    tracking_ref = "refs/remotes/origin/%s" % branch
+    remote_oid = state.get("remote_oid")
+    moved = read_ref(repo_path, "HEAD") != state.get("head_oid")
+    merged = not moved and remote_oid is not None and remote_oid == state.get("merged_oid")
+    if merged:
+        logger.info("remote unchanged, skip fetch and merge")
+        record_skip(state, "fetch")
+        return moved, merged, False
+    if remote_oid is not None and remote_oid == read_ref(repo_path, tracking_ref):
+        logger.info("remote already fetched, skip fetch")
+        record_skip(state, "fetch")
+        return moved, merged, False
+    return moved, merged, True
+
+#the commit phase of a sync, return the return code, 0 if skipped
+def sync_commit(name, repo_path, commit, moved, state):
+    if not (commit or moved or state.get("commit_due") or index_signature(repo_path) != state.get("index_sig")):
+        record_skip(state, "commit")
+        return 0
+    with sync_phase(name, "commit") as phase:
+        r = git_commit(repo_path, state)
+        phase.ok = r == 0
+    record_outcome(state, "commit", r)
+    return r
+
+#the merge phase of a sync, return the return code, 0 if skipped
+def sync_merge(name, repo_path, branch, merged, state):
+    if merged:
+        record_skip(state, "merge")
+        return 0
+    with sync_phase(name, "merge") as phase:
+        r = git_merge(repo_path, branch)
+        phase.ok = r == 0
+    record_outcome(state, "merge", r)
+    if r == 0:
+        record_merged(repo_path, branch, state)
+    return r
+
+#HEAD contains everything up to the fetched remote tip, after a merge or a push
+def record_merged(repo_path, branch, state):
+    update_state(state, merged_oid=read_ref(repo_path, "refs/remotes/origin/%s" % branch))
+
+def record_synced(repo_path, state):
+    update_state(state, head_oid=read_ref(repo_path, "HEAD"), index_sig=index_signature(repo_path))
+
+
 # branch: current branch
-def sync_repo(repo_path, branch):
-    print("sync repo:", repo_path, " branch:", branch)
-    r = git_fetch(repo_path)
-    if r != 0:
-        return False
-    
-    r = git_commit(repo_path)
-    if r != 0:
+# commit: False if the worktree is known to be unchanged, skip git status
+# state: the repo's persistent sync state
+#        remote_oid: the remote branch tip from the probe, None if unknown
+#        merged_oid: the last remote tip merged into HEAD
+#        head_oid, index_sig: HEAD and index after the last successful sync
+#        outcome: phase => return code of its last run
+#        skipped: phase => times the phase was skipped
+#        dirty_since, commit_due: the quiet period of a deferred commit, see git_commit
+#the network phases are engine specific, aiosync.AsyncSync.sync_repo awaits them around the same helpers
+def sync_repo(repo_path, branch, commit=True, state=None):
+    logger.info("sync repo: %s branch: %s", repo_path, branch)
+    name = os.path.basename(repo_path)
+    if state is None:
+        state = {}
+
+    moved, merged, fetch = plan_sync(repo_path, branch, state)
+    if fetch:
+        with sync_phase(name, "fetch") as phase:
+            r = git_fetch(repo_path)
+            phase.ok = r == 0
+        record_outcome(state, "fetch", r)
+        if r != 0:
+            return False
+
+    if sync_commit(name, repo_path, commit, moved, state) != 0:
         return False
-    
-    r = git_merge(repo_path, branch)
-    if r != 0:
+    if sync_merge(name, repo_path, branch, merged, state) != 0:
         return False
 
     if not need_push(repo_path, branch):
-        print("no commit to push")
-        return True
-    
-    r = git_push(repo_path)
-    if r != 0:
-        return False
+        logger.info("no commit to push")
+        record_skip(state, "push")
+    else:
+        with sync_phase(name, "push") as phase:
+            if squash_push:
+                squash_auto_commits(repo_path, branch)
+            r = git_push(repo_path)
+            phase.ok = r == 0
+        record_outcome(state, "push", r)
+        if r != 0:
+            return False
+        record_merged(repo_path, branch, state)
+
+    record_synced(repo_path, state)
     return True
 
 
+def read_state_db(workspace):
+    path = os.path.join(workspace, ".repos-state")
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+            if not data:
+                return {}
+            return json.loads(data.decode("utf8"))
+    except (OSError, ValueError) as e:
+        return {}
+
+def write_state_db(workspace, states):
+    path = os.path.join(workspace, ".repos-state")
+    data = json.dumps(states)
+    storage.write_atomic(path, data.encode("utf8"))
+
+
+#git@github.com:user/repo.git, ssh://git@host:22/user/repo.git, https://host/user/repo
+def get_url_host(url):
+    m = re.match(r"^[a-zA-Z][a-zA-Z0-9+.-]*://(?:[^@/]*@)?([^:/]+)", url)
+    if m:
+        return m.group(1).lower()
+    m = re.match(r"^(?:[^@/]*@)?([^:/]+):", url)
+    if m:
+        return m.group(1).lower()
+    #local path
+    return ""
+
+
+#"name(host-conflicted-copy-2024-01-31)-(1).ext" of generate_conflicted_filename,
+#and "name(host conflicted copy 2024-01-31) (1).ext" of git-cloud-merge.py
+CONFLICTED_COPY_RE = re.compile(r"^(.*)\((.*?)[- ]conflicted[- ]copy[- ](\d{4}-\d{2}-\d{2})\)(?:[- ]\(\d+\))?(\.[^./]*)?$")
+
+#(original path, host, date) of a conflicted copy, None if it isn't one
+def conflicted_original(path):
+    m = CONFLICTED_COPY_RE.match(path)
+    if not m:
+        return None
+    name, host, date, ext = m.groups()
+    return name + (ext or ""), host, date
+
 def generate_conflicted_filename(filename):
     name, ext = os.path.splitext(filename)
     today = datetime.date.today()
@@ -267,103 +1076,434 @@ def generate_conflicted_filename(filename):
 
 
 class Sync(object):
-    def __init__(self, repos, event_q, interval, excludesFile):
-        self.last_sync_time = 0
-        self.is_syncing = False
+    def __init__(self, repos, event_q, interval, excludesFile, workers=config.SYNC_WORKERS, host_workers=config.SYNC_HOST_WORKERS, watch=False):
         self.repos = repos
         self.event_q = event_q
         self.sync_interval = interval
         self.excludesFile = excludesFile
+        #global attributes of the binary types, see main.createAttributesFile
+        self.attributesFile = None
+        self.host_workers = host_workers
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sync")
+        self.lock = threading.Lock()
+        #host => semaphore, limit concurrent syncs against one git server
+        self.host_sems = {}
+        #names of the repos owned by a worker, a repo is never synced by two workers at once
+        self.syncing_repos = set()
+        self.watch = watch
+        self.watcher = None
+        #name => sync state of the repo, see sync_repo
+        self.states = {}
+        self.q = None
+        #names of the repos with a sync request waiting in q
+        self.requested = set()
+        #long safety net interval when remote and local changes are both notified
+        self.poll_interval = None
+        self.scheduler = Scheduler()
+        #name => repo, one-off syncs of disabled repos
+        self.forced = {}
+        #names of the repos submitted to the pool
+        self.dispatched = set()
+        #names due again while they were still syncing
+        self.deferred = set()
+        self.idle = threading.Condition(self.lock)
+        #serialize the writes of the state file, two passes can end back to back
+        self.save_lock = threading.Lock()
+        #repos submitted and not done
+        self.inflight = 0
+        from clone import Cloner
+        self.cloner = Cloner(self)
+        from mirror import Mirrors
+        self.mirrors = Mirrors()
+        #objectcache.ObjectCache borrowed by the new clones, None if disabled
+        self.object_cache = None
+        #history.History indexed after each sync, None if disabled
+        self.history = None
 
     def set_interval(self, interval):
         self.sync_interval = interval
+        #a shorter interval takes effect now, a longer one after the next sync
+        self.scheduler.clamp(time.time() + self.get_interval())
+
+    def get_interval(self):
+        if self.poll_interval and self.watcher:
+            return max(self.sync_interval, self.poll_interval)
+        return self.sync_interval
+
+    #queue a sync of one repo, dropped if one is already waiting
+    def request_sync(self, name, source):
+        with self.lock:
+            if name in self.requested:
+                return False
+            self.requested.add(name)
+        self.q.put(sync_request(name, source))
+        return True
+
+    def get_host_semaphore(self, url):
+        host = get_url_host(url)
+        with self.lock:
+            sem = self.host_sems.get(host)
+            if sem is None:
+                sem = threading.BoundedSemaphore(self.host_workers)
+                self.host_sems[host] = sem
+            return sem
+
+    def acquire_repo(self, name):
+        with self.lock:
+            if name in self.syncing_repos:
+                return False
+            self.syncing_repos.add(name)
+            return True
+
+    def release_repo(self, name):
+        with self.lock:
+            self.syncing_repos.discard(name)
+
+    def get_state(self, name):
+        with self.lock:
+            return self.states.setdefault(name, {})
+
+    #a deep copy of the repo state, or of its field
+    def copy_state(self, name, key=None):
+        state = self.get_state(name)
+        with state_lock:
+            return copy.deepcopy(state if key is None else state.get(key))
+
+    def skipped_phases(self):
+        with self.lock:
+            states = list(self.states.values())
+        with state_lock:
+            return sum(sum(state.get("skipped", {}).values()) for state in states)
+
+    def save_states(self, workspace):
+        names = set(repo["name"] for repo in self.repos)
+        with self.lock:
+            states = {name:state for name, state in self.states.items() if name in names}
+        with state_lock:
+            #the probe result is only valid for the current pass
+            states = {name:copy.deepcopy({k:v for k, v in state.items() if k != "remote_oid"}) for name, state in states.items()}
+        with self.save_lock:
+            try:
+                write_state_db(workspace, states)
+            except OSError as e:
+                #the states are saved again at the end of the next pass
+                logger.warning("save states error: %s", e)
+
+    #the remote tip for sync_repo's skips, probed by the worker that owns the repo,
+    #the repos of a host share the ssh connection
+    def probe_repo(self, name, repo_path, branch, state):
+        #unknown remote tip, sync_repo does a full fetch
+        pop_state(state, "remote_oid")
+        with subprocess.context(name, "probe"):
+            heads = git_ls_remote(repo_path)
+        record_probe(state, heads, branch)
+
+    #check out the selected folders once local changes are committed and pushed
+    def apply_folders(self, repo, repo_path):
+        state = self.get_state(repo["name"])
+        folders = repo.get("folders")
+        if folders == state.get("folders"):
+            return
+        logger.info("sparse checkout: %s %s", repo["name"], folders)
+        if git_sparse_checkout(repo_path, folders) == 0:
+            update_state(state, folders=folders)
+
+    #return (result, active) or None if the repo is owned by another worker
+    def sync_one(self, repo, workspace):
+        if not self.acquire_repo(repo["name"]):
+            logger.info("repo is syncing by other worker, skip: %s", repo["name"])
+            return None
+        try:
+            with self.get_host_semaphore(repo["url"]), subprocess.context(repo["name"]):
+                head = self.get_state(repo["name"]).get("head_oid")
+                r = self._sync_one(repo, workspace)
+                #a local commit or a merged remote change moves HEAD
+                return r, self.get_state(repo["name"]).get("head_oid") != head
+        finally:
+            self.release_repo(repo["name"])
+
+    def _sync_one(self, repo, workspace):
+        begin = self.begin_sync(repo, workspace)
+        if begin is None:
+            return False
+        repo_path, branch, commit, state = begin
+        self.probe_repo(repo["name"], repo_path, branch, state)
+        with sync_phase(repo["name"], "sync") as phase:
+            r = sync_repo(repo_path, branch, commit, state)
+            phase.ok = r
+        self.end_sync(repo, repo_path, r)
+        return r
+
+    #return (repo_path, branch, commit, state) of sync_repo, None if the repo isn't cloned
+    def begin_sync(self, repo, workspace):
+        repo_path = os.path.join(workspace, repo["name"])
+        if not os.path.exists(repo_path):
+            #the clone job didn't finish
+            return None
+
+        commit = True
+        if self.watcher:
+            self.watcher.watch(repo["name"], repo_path)
+            commit = self.watcher.take_dirty(repo["name"])
+
+        self.event_q.put_nowait({"event":"repo_begin", "name":repo["name"], "syncing":True, "lastSyncTime":int(time.time())})
+        if "branch" in repo:
+            branch = repo["branch"]
+        else:
+            branch = get_branch(repo_path)
+            logger.info("repo: %s branch: %s", repo_path, branch)
+            if branch:
+                repo["branch"] = branch
+
+        if not branch:
+            branch = "master"
+            #warning
+            logger.warning("can't get repo branch %s use default master branch", repo_path)
+
+        state = self.get_state(repo["name"])
+        update_state(state, branch=branch)
+        return repo_path, branch, commit, state
+
+    def end_sync(self, repo, repo_path, r):
+        if r:
+            self.apply_folders(repo, repo_path)
+        self.event_q.put_nowait({"event":"repo_end", "name":repo["name"], "syncing":False, "result":r})
+        if r and repo.get("mirrors"):
+            state = self.get_state(repo["name"])
+            self.mirrors.push(repo["name"], repo_path, state["branch"], state["head_oid"], repo["mirrors"])
+        if r and self.history:
+            #the first index of a long history takes a while, the repo is still held
+            try:
+                self.history.update(repo_path)
+            except Exception as e:
+                logger.warning("history index error: %s %s", repo_path, e)
+
+    def schedule(self, name, due):
+        self.event_q.put_nowait({"event":"repo_schedule", "name":name, "nextSyncTime":int(due)})
+
+    #sync is done, pick the next due time of the repo
+    def repo_done(self, repo, f, workspace):
+        name = repo["name"]
+        try:
+            r = f.result()
+        except Exception as e:
+            logger.warning("sync repo exception: %s %s", name, e)
+            r = (False, False)
+
+        with self.lock:
+            self.dispatched.discard(name)
+            deferred = name in self.deferred
+            self.deferred.discard(name)
+            scheduled = any(repo["name"] == name and not repo["disabled"] for repo in self.repos)
+        if not scheduled:
+            self.scheduler.remove(name)
+        elif deferred:
+            self.scheduler.urgent(name)
+        elif r is None:
+            #maintenance owns the repo, retry soon
+            self.schedule(name, self.scheduler.schedule(name, time.time() + config.SCHEDULE_MIN_INTERVAL))
+        else:
+            result, active = r
+            due = self.scheduler.record(name, self.get_interval(), bool(result), active)
+            #a commit deferred by the quiet period
+            commit_due = self.get_state(name).get("commit_due")
+            if commit_due and commit_due < due:
+                due = self.scheduler.schedule(name, commit_due)
+            self.schedule(name, due)
+
+        with self.lock:
+            self.inflight -= 1
+            idle = self.inflight == 0
+        if idle:
+            self.save_states(workspace)
+            logger.info("skipped phases: %s", self.skipped_phases())
+            self.event_q.put_nowait({"event":"end"})
+            with self.lock:
+                if self.inflight == 0:
+                    self.idle.notify_all()
+        if self.q:
+            #the next due time may have moved
+            self.q.put(WAKEUP)
 
-    def sync_repos(self, repos, workspace):
+    #clone is done, sync the repo now or retry the clone with backoff
+    def clone_done(self, job):
+        name = job.name
+        if job.cancelled:
+            logger.info("clone cancelled: %s", name)
+            return
+        with self.lock:
+            scheduled = any(repo["name"] == name and not repo["disabled"] for repo in self.repos)
+        if job.result == 0:
+            state = self.get_state(name)
+            if job.depth:
+                update_state(state, pruned_at=int(time.time()))
+            #a new clone checks out only the root files
+            pop_state(state, "folders")
+            if not scheduled:
+                #a forced clone of a disabled repo is synced once too
+                self.forced[name] = job.repo
+            due = self.scheduler.urgent(name)
+        elif scheduled:
+            due = self.scheduler.record(name, self.get_interval(), False, False)
+        else:
+            return
+        self.schedule(name, due)
+        if self.q:
+            self.q.put(WAKEUP)
+
+    def sync_repos(self, repos, workspace, wait=True):
+        repos = [repo for repo in repos if not repo["disabled"]]
         if not repos:
             return
 
-        print("sync repos:", repos, workspace)
-        self.event_q.put_nowait({"event":"begin"})
+        logger.debug("sync repos: %s %s", repos, workspace)
+        #interleave hosts, so the workers aren't all blocked on one host's semaphore
+        hosts = {}
         for repo in repos:
-            repo_path = os.path.join(workspace, repo["name"])
-            if repo["disabled"]:
-                continue
-            if not os.path.exists(repo_path):
-                self.event_q.put_nowait({"event":"repo_begin", "name":repo["name"], "syncing":True})
-                r = git_clone(repo_path, repo["url"])
-                if r == 0:
-                    r = git_config(repo_path, self.excludesFile)
-                self.event_q.put_nowait({"event":"repo_end", "name":repo["name"], "syncing":False, "result":r})
-                branch = get_branch(repo_path)
-                if branch:
-                    repo["branch"] = branch
-                    print("repo:", repo_path, " branch:", branch)
+            hosts.setdefault(get_url_host(repo["url"]), []).append(repo)
+        queues = list(hosts.values())
+        ordered = []
+        while queues:
+            ordered.extend(q.pop(0) for q in queues)
+            queues = [q for q in queues if q]
 
-        for repo in repos:
-            repo_path = os.path.join(workspace, repo["name"])
-            if repo["disabled"]:
-                continue
-            if not os.path.exists(repo_path):
-                continue
-            self.event_q.put_nowait({"event":"repo_begin", "name":repo["name"], "syncing":True})
-            if "branch" in repo:
-                branch = repo["branch"]
-            else:
-                branch = get_branch(repo_path)
-                print("repo:", repo_path, " branch:", branch)
+        #the new repos are cloned in the background, synced once the clone is done
+        clones = [repo for repo in ordered if not os.path.exists(os.path.join(workspace, repo["name"]))]
+        for repo in clones:
+            if not self.cloner.start(repo, workspace):
+                logger.info("repo is cloning, skip: %s", repo["name"])
+        self.dispatch([repo for repo in ordered if repo not in clones], workspace)
+
+        if wait:
+            if clones:
+                self.cloner.wait([repo["name"] for repo in clones])
+                self.dispatch([repo for repo in clones if os.path.exists(os.path.join(workspace, repo["name"]))], workspace)
+            with self.lock:
+                while self.inflight:
+                    self.idle.wait()
 
-            if not branch:
-                branch = "master"
-                #warning
-                print("can't get repo branch ", repo_path, " use default master branch")
+    def dispatch(self, repos, workspace):
+        if not repos:
+            return
+        for repo in repos:
+            with self.lock:
+                self.inflight += 1
+                begin = self.inflight == 1
+                self.dispatched.add(repo["name"])
+            if begin:
+                self.event_q.put_nowait({"event":"begin"})
+            f = self.submit(repo, workspace)
+            f.add_done_callback(lambda f, repo=repo: self.repo_done(repo, f, workspace))
 
-            r = sync_repo(repo_path, branch)
-            self.event_q.put_nowait({"event":"repo_end", "name":repo["name"], "syncing":False, "result":r})
+    #start the sync of one repo, return a concurrent.futures.Future of sync_one's result
+    def submit(self, repo, workspace):
+        return self.pool.submit(self.sync_one, repo, workspace)
 
-        self.event_q.put_nowait({"event":"end"})
+    #sync the due repos without waiting, the pool reports back through repo_done
+    def sync_due(self, workspace):
+        repos = []
+        for name in self.scheduler.pop_due(time.time()):
+            with self.lock:
+                if name in self.dispatched:
+                    self.deferred.add(name)
+                    continue
+            repo = self.forced.pop(name, None)
+            if repo is None:
+                repo = next((repo for repo in self.repos if repo["name"] == name and not repo["disabled"]), None)
+            if repo is not None:
+                repos.append(repo)
+        self.sync_repos(repos, workspace, False)
 
     def handle_item(self, item):
-        repos = self.repos
-        ret = False
-        force = item.get("force", False)
-        if item["disabled"] and not force:
+        name = item["name"]
+        rs = [repo for repo in self.repos if repo["name"] == name]
+        if item.get("force", False):
+            if not rs or rs[0]["disabled"]:
+                #sync a disabled repo once
+                repo = item.copy()
+                repo["disabled"] = False
+                self.forced[name] = repo
+            logger.info("force sync repo: %s", name)
+            self.scheduler.urgent(name)
+            return
+        if item["disabled"]:
             #remove
-            self.repos = [repo for repo in repos if repo["name"] != item["name"]]
-            print("rm sync repo:", item["name"], self.repos)
-            return False
+            self.repos = [repo for repo in self.repos if repo["name"] != name]
+            self.scheduler.remove(name)
+            self.cloner.cancel(name)
+            logger.info("rm sync repo: %s %s", name, self.repos)
+            if self.watcher:
+                self.watcher.unwatch(name)
+            if item.get("deleted") and self.object_cache:
+                thread = threading.Thread(target=self.release_objects, daemon=True, args=(name,))
+                thread.start()
+            return
+
+        #add
+        if not rs:
+            assert("url" in item)
+            self.repos.append(item.copy())
+            logger.info("add sync repo: %s", name)
         else:
-            #add
-            repos = [repo for repo in repos if repo["name"] == item["name"]]
-            if not repos :
-                assert("url" in item)
-                self.repos.append(item.copy())
-                print("add sync repo:", item["name"])
-            else:
-                repos[0]["disabled"] = item["disabled"]
-                repos[0]["force"] = force
-                print("enable sync repo:", item["name"])
-            return True
+            rs[0]["disabled"] = False
+            for key in ("shallow", "depth", "folders", "mirrors"):
+                if key in item:
+                    rs[0][key] = item[key]
+            logger.info("enable sync repo: %s", name)
+        self.scheduler.urgent(name)
+
+    #a deleted repo stops borrowing from the object cache once it isn't syncing
+    def release_objects(self, name):
+        while not self.acquire_repo(name):
+            time.sleep(1)
+        try:
+            self.object_cache.release(name)
+        except OSError as e:
+            logger.warning("release objects error: %s %s", name, e)
+        finally:
+            self.release_repo(name)
 
     def run(self, q, workspace):
-        self.sync_repos(self.repos, workspace)
+        self.states = read_state_db(workspace)
+        now = time.time()
+        for repo in self.repos:
+            if not repo["disabled"]:
+                #due times survive restarts, missed ones are due now
+                self.scheduler.schedule(repo["name"], min(repo.get("nextSyncTime", now), now + self.get_interval()))
         while True:
+            due = self.scheduler.next_due()
+            timeout = None if due is None else max(0, due - time.time())
             try:
-                print("run wait:", self.sync_interval)
-                item = q.get(timeout=self.sync_interval)
-                print("get item:", item)
+                logger.debug("run wait: %s", timeout)
+                item = q.get(timeout=timeout)
+                logger.debug("get item: %s", item)
                 if item is WAKEUP:
                     continue
-                r = self.handle_item(item)
-                if not r:
-                    #remove repo or unchanged
+                if item.get("request") == "sync":
+                    with self.lock:
+                        self.requested.discard(item["name"])
+                    if any(repo["name"] == item["name"] for repo in self.repos):
+                        self.scheduler.urgent(item["name"])
                     continue
+                self.handle_item(item)
+                continue
             except queue.Empty as e:
                 pass
 
-            self.sync_repos(self.repos, workspace)
-            self.repos = [repo for repo in self.repos if not repo["disabled"] and not repo.get("force")]
+            self.sync_due(workspace)
 
     def start(self, q, workspace):
+        self.q = q
+        from maintenance import Maintenance
+        self.maintenance = Maintenance(self, workspace)
+        self.maintenance.start()
+        if self.watch:
+            from watcher import Watcher
+            if Watcher.available():
+                self.watcher = Watcher(self, self.excludesFile)
+                self.watcher.start()
+            else:
+                logger.warning("watchdog isn't installed, fall back to interval sync")
         thread = threading.Thread(target=self.run, daemon=True, args=(q, workspace))
         thread.start()
     
@@ -374,6 +1514,63 @@ def set_env_path(path):
     env["PATH"] = path
 
 
+#(major, minor) of the git command, (0, 0) if unknown
+def git_version():
+    p = subprocess.Popen(["git", "version"], stdout=subprocess.PIPE, env=env, text=True)
+    out, _ = p.communicate()
+    m = re.search(r"(\d+)\.(\d+)", out)
+    if not m:
+        return (0, 0)
+    return int(m.group(1)), int(m.group(2))
+
+
+#the --sparse option of git add and git rm (git 2.34), without it a new path outside
+#the selected folders of a sparse checkout, e.g. a new top level folder, fails the whole add
+add_sparse = None
+def sparse_args():
+    global add_sparse
+    if add_sparse is None:
+        add_sparse = git_version() >= (2, 34)
+        if not add_sparse:
+            logger.warning("git is too old for git add --sparse, new folders outside the selected folders fail the commit")
+    return ["--sparse"] if add_sparse else []
+
+
+def set_merge_engine(name):
+    global merge_engine
+    if name == "merge-tree":
+        #git merge-tree --write-tree is new in git 2.38
+        version = git_version()
+        if version < (2, 38):
+            logger.warning("git is too old for merge-tree engine: %s", version)
+            return
+    merge_engine = name
+
+
+def set_commit_coalescing(quiet, max_delay=config.COMMIT_MAX_DELAY, squash=False):
+    global commit_quiet, commit_max_delay, squash_push
+    commit_quiet = quiet
+    commit_max_delay = max(quiet, max_delay)
+    squash_push = squash
+
+
+def set_parallel_hash(enabled):
+    global parallel_hash
+    parallel_hash = enabled
+
+
+def set_git_engine(name):
+    global engine
+    if name == "pygit2":
+        from gitengine import Pygit2Engine
+        if not Pygit2Engine.available():
+            logger.warning("pygit2 isn't installed, use subprocess git engine")
+            return
+        engine = Pygit2Engine(SubprocessEngine())
+    else:
+        engine = SubprocessEngine()
+
+
 
 if __name__ == "__main__":
     print(sys.argv)
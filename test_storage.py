@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+import os
+import errno
+import tempfile
+import unittest
+from unittest import mock
+import storage
+from storage import Store, read_json
+
+
+class StoreFlushTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "db.json")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def load(self):
+        return Store(self.path).load([])
+
+    #a failed full write is retried by the next flush, not replaced by a journal record
+    def test_failed_save_is_retried(self):
+        store = Store(self.path)
+        store.load([{"name":"a"}])
+        store.save([{"name":"a"}, {"name":"b"}])
+        with mock.patch.object(storage, "write_atomic", side_effect=OSError(errno.ENOSPC, "No space left on device")):
+            with self.assertRaises(OSError):
+                store.flush()
+        store.update("b", {"x":1})
+        store.flush()
+        self.assertEqual(self.load(), [{"name":"a"}, {"name":"b", "x":1}])
+
+    #a failed journal append is retried by a full write
+    def test_failed_journal_append_is_retried(self):
+        store = Store(self.path)
+        store.load([])
+        store.save([{"name":"a"}])
+        store.flush()
+        store.update("a", {"x":1})
+        with mock.patch("builtins.open", side_effect=OSError(errno.EACCES, "Permission denied")):
+            with self.assertRaises(OSError):
+                store.flush()
+        store.flush()
+        self.assertEqual(read_json(self.path, None), [{"name":"a", "x":1}])
+        self.assertFalse(os.path.exists(store.journal_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+import os
+import time
+import fnmatch
+import threading
+import logging
+import config
+
+logger = logging.getLogger(__name__)
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+
+def read_excludes(excludes_file):
+    patterns = []
+    try:
+        with open(excludes_file, "r", encoding="utf8") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#") or line.startswith("!"):
+                    continue
+                patterns.append(line.rstrip("/"))
+    except OSError as e:
+        pass
+    return patterns
+
+
+class RepoEventHandler(FileSystemEventHandler):
+    EVENT_TYPES = ("created", "deleted", "modified", "moved")
+
+    def __init__(self, watcher, name, repo_path):
+        super().__init__()
+        self.watcher = watcher
+        self.name = name
+        self.repo_path = repo_path
+
+    def on_any_event(self, event):
+        if event.event_type not in self.EVENT_TYPES:
+            return
+        if event.event_type == "modified" and event.is_directory:
+            #a child changed, the child has its own event
+            return
+        paths = [event.src_path]
+        if event.event_type == "moved":
+            paths.append(event.dest_path)
+        if any(not self.watcher.is_ignored(self.repo_path, path) for path in paths):
+            self.watcher.touch(self.name)
+
+
+#a repo is committed only when its watch saw a change, or its full git status is due:
+#the watch failed (e.g. inotify ran out of max_user_watches) or the last one is rescan seconds old
+class Watcher(object):
+    def __init__(self, sync, excludesFile, debounce=config.WATCH_DEBOUNCE, max_delay=config.WATCH_MAX_DELAY, rescan=config.WATCH_RESCAN):
+        self.sync = sync
+        self.excludes = read_excludes(excludesFile)
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.rescan = rescan
+        self.lock = threading.Lock()
+        #name => watchdog ObservedWatch, None if the watch failed
+        self.watches = {}
+        #name => time of the last full status
+        self.scanned = {}
+        #names of the repos whose watch failed, warned once
+        self.broken = set()
+        #name => (first event time, last event time), waiting for debounce
+        self.pending = {}
+        #names of the repos changed since their last commit
+        self.dirty = set()
+        self.observer = Observer() if Observer else None
+
+    @staticmethod
+    def available():
+        return Observer is not None
+
+    def is_ignored(self, repo_path, path):
+        rel = os.path.relpath(path, repo_path)
+        parts = rel.split(os.sep)
+        if ".git" in parts:
+            return True
+        for pattern in self.excludes:
+            if "/" in pattern:
+                if fnmatch.fnmatch(rel.replace(os.sep, "/"), pattern.lstrip("/")):
+                    return True
+            elif any(fnmatch.fnmatch(part, pattern) for part in parts):
+                return True
+        return False
+
+    #the observer calls touch holding its own lock, so it's never called holding self.lock
+    def watch(self, name, repo_path):
+        with self.lock:
+            if name in self.watches:
+                return
+            self.watches[name] = None
+            #changes made while nobody was watching
+            self.dirty.add(name)
+        handler = RepoEventHandler(self, name, repo_path)
+        try:
+            w = self.observer.schedule(handler, repo_path, recursive=True)
+        except OSError as e:
+            logger.warning("watch repo error, full status on every sync: %s %s", name, e)
+            with self.lock:
+                self.broken.add(name)
+            return
+        with self.lock:
+            if name in self.watches:
+                self.watches[name] = w
+                w = None
+        if w is not None:
+            #unwatched meanwhile
+            self.observer.unschedule(w)
+            return
+        logger.info("watch repo: %s %s", name, repo_path)
+
+    def unwatch(self, name):
+        with self.lock:
+            w = self.watches.pop(name, None)
+            self.pending.pop(name, None)
+            self.dirty.discard(name)
+            self.scanned.pop(name, None)
+            self.broken.discard(name)
+        if w is not None:
+            self.observer.unschedule(w)
+            logger.info("unwatch repo: %s", name)
+
+    def touch(self, name):
+        now = time.time()
+        with self.lock:
+            self.dirty.add(name)
+            first, _ = self.pending.get(name, (now, now))
+            self.pending[name] = (first, now)
+
+    #watchdog reports a watch that fails later, e.g. on a new folder, only by ending its emitter thread
+    def is_watching(self, w):
+        if w is None or not self.observer.is_alive():
+            return False
+        return any(emitter.watch == w and emitter.is_alive() for emitter in self.observer.emitters)
+
+    #return True if the worktree changed since the last call, or its full status is due
+    def take_dirty(self, name):
+        with self.lock:
+            w = self.watches.get(name)
+        watching = self.is_watching(w)
+        now = time.time()
+        with self.lock:
+            dirty = name in self.dirty or not watching or now - self.scanned.get(name, 0) >= self.rescan
+            self.dirty.discard(name)
+            if watching:
+                self.broken.discard(name)
+            elif name not in self.broken:
+                self.broken.add(name)
+                logger.warning("repo isn't watched, full status on every sync: %s", name)
+            if dirty:
+                self.scanned[name] = now
+        return dirty
+
+    def run(self):
+        while True:
+            time.sleep(min(self.debounce, 0.5))
+            now = time.time()
+            ready = []
+            with self.lock:
+                for name, (first, last) in list(self.pending.items()):
+                    if now - last >= self.debounce or now - first >= self.max_delay:
+                        ready.append(name)
+                        self.pending.pop(name)
+            for name in ready:
+                logger.info("repo changed: %s", name)
+                self.sync.request_sync(name, "watch")
+
+    def start(self):
+        self.observer.daemon = True
+        self.observer.start()
+        thread = threading.Thread(target=self.run, daemon=True, args=())
+        thread.start()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+import sys
+import re
+import json
+import hmac
+import hashlib
+import threading
+import urllib.parse
+import urllib.request
+import urllib.error
+import logging
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import config
+from sync import get_url_host
+
+logger = logging.getLogger(__name__)
+
+
+#git@github.com:user/repo.git, https://github.com/user/repo => github.com/user/repo
+def repo_key(url):
+    host = get_url_host(url)
+    m = re.match(r"^[a-zA-Z][a-zA-Z0-9+.-]*://[^/]*(/.*)$", url)
+    if m:
+        path = m.group(1)
+    elif ":" in url:
+        path = url.split(":", 1)[1]
+    else:
+        path = url
+    path = path.strip("/")
+    if path.endswith(".git"):
+        path = path[:-4]
+    return (host + "/" + path).lower()
+
+
+#clone urls of the pushed repo, github/gitea/gogs use "repository", gitlab uses "project"
+def payload_urls(payload):
+    urls = []
+    for key in ("repository", "project"):
+        obj = payload.get(key)
+        if not isinstance(obj, dict):
+            continue
+        for field in ("clone_url", "ssh_url", "git_url", "html_url", "url", "git_ssh_url", "git_http_url"):
+            if isinstance(obj.get(field), str):
+                urls.append(obj[field])
+    return urls
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if not self.server.webhook.verify(body, self.headers):
+            self.send_response(403)
+            self.end_headers()
+            return
+
+        event = self.headers.get("X-GitHub-Event") or self.headers.get("X-Gitea-Event") or self.headers.get("X-Gogs-Event") or "push"
+        event = self.headers.get("X-Gitlab-Event", event)
+        if event.lower() not in ("push", "push hook"):
+            #ping and others
+            self.send_response(204)
+            self.end_headers()
+            return
+
+        try:
+            if self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+                body = urllib.parse.parse_qs(body.decode("utf8"))["payload"][0].encode("utf8")
+            payload = json.loads(body.decode("utf8"))
+        except (ValueError, KeyError) as e:
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        names = self.server.webhook.handle_push(payload)
+        self.send_response(200 if names else 404)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps({"repos":names}).encode("utf8"))
+
+    def log_message(self, format, *args):
+        logger.info("webhook: %s", format % args)
+
+
+#accept push notifications and sync the pushed repo right away
+class Webhook(object):
+    def __init__(self, sync, port=config.WEBHOOK_PORT, secret=None, host="127.0.0.1"):
+        self.sync = sync
+        self.secret = secret
+        self.server = ThreadingHTTPServer((host, port), WebhookHandler)
+        self.server.webhook = self
+
+    def verify(self, body, headers):
+        if not self.secret:
+            return True
+        signature = headers.get("X-Hub-Signature-256") or headers.get("X-Gitea-Signature") or ""
+        if signature.startswith("sha256="):
+            signature = signature[7:]
+        digest = hmac.new(self.secret.encode("utf8"), body, hashlib.sha256).hexdigest()
+        if hmac.compare_digest(digest, signature):
+            return True
+        #gitlab sends the secret itself
+        return hmac.compare_digest(headers.get("X-Gitlab-Token", ""), self.secret)
+
+    def handle_push(self, payload):
+        keys = set(repo_key(url) for url in payload_urls(payload))
+        names = [repo["name"] for repo in list(self.sync.repos) if repo_key(repo["url"]) in keys]
+        for name in names:
+            logger.info("webhook push: %s", name)
+            self.sync.request_sync(name, "webhook")
+        return names
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True, args=())
+        thread.start()
+
+
+#fake sender for testing: python3 webhook.py <port> <repo url> [secret]
+def send_push(port, url, secret=None):
+    body = json.dumps({"ref":"refs/heads/master", "repository":{"clone_url":url}}).encode("utf8")
+    req = urllib.request.Request("http://127.0.0.1:%d/" % port, data=body, method="POST")
+    req.add_header("Content-Type", "application/json")
+    req.add_header("X-GitHub-Event", "push")
+    if secret:
+        digest = hmac.new(secret.encode("utf8"), body, hashlib.sha256).hexdigest()
+        req.add_header("X-Hub-Signature-256", "sha256=" + digest)
+    try:
+        with urllib.request.urlopen(req) as resp:
+            return resp.status, json.loads(resp.read().decode("utf8"))
+    except urllib.error.HTTPError as e:
+        return e.code, None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("usage: webhook.py <port> <repo url> [secret]")
+        sys.exit(1)
+    print(send_push(int(sys.argv[1]), sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None))